@@ -0,0 +1,194 @@
+"""Caching of search results.
+
+Set the ``result_cache`` attribute of an index class to one of the
+backends defined here, and ``Index.search`` will cache what it found
+for each combination of query, page and search options:
+
+    class MyIndex(Index):
+        result_cache = LocMemResultCache(max_entries=1000)
+
+What is cached are the ids, stored data, and ranking information of the
+hits on the page, the match counts, facets (if requested), and the
+spelling suggestion - not any Xapian objects. The cache key includes
+the revision of the index, so any flush to the index automatically
+invalidates all existing entries.
+"""
+
+import threading
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+
+
+__all__ = ('LocMemResultCache', 'DjangoResultCache', 'make_key',)
+
+
+# the index metadata key storing the current revision; updated on
+# every flush (see ``Index.flush``).
+REVISION_KEY = 'django_xappy.revision'
+
+
+def make_key(*parts):
+    """Build a cache key from the given values, which need to have a
+    stable ``repr()``.
+    """
+    return md5(repr(parts)).hexdigest()
+
+
+class LocMemResultCache(object):
+    """Keeps the ``max_entries`` most recently used results in the
+    memory of the current process.
+    """
+
+    def __init__(self, max_entries=500):
+        self.max_entries = max_entries
+        self._entries = {}
+        self._tick = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            try:
+                tick, value = self._entries[key]
+            except KeyError:
+                return None
+            self._tick += 1
+            self._entries[key] = (self._tick, value)
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            if len(self._entries) >= self.max_entries and \
+                    key not in self._entries:
+                self._cull()
+            self._tick += 1
+            self._entries[key] = (self._tick, value)
+        finally:
+            self._lock.release()
+
+    def _cull(self):
+        # Remove the least recently used quarter of the entries at once,
+        # so we don't have to sort on every single insert.
+        by_age = sorted(self._entries.items(), key=lambda item: item[1][0])
+        for key, entry in by_age[:max(1, len(by_age)/4)]:
+            del self._entries[key]
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries = {}
+        finally:
+            self._lock.release()
+
+
+class DjangoResultCache(object):
+    """Stores results using Django's cache framework, i.e. the backend
+    configured by the ``CACHE_BACKEND`` setting, so that they can be
+    shared between processes and servers.
+    """
+
+    def __init__(self, timeout=None, key_prefix='django_xappy:'):
+        self.timeout = timeout
+        self.key_prefix = key_prefix
+
+    def get(self, key):
+        from django.core.cache import cache
+        return cache.get(self.key_prefix + key)
+
+    def set(self, key, value):
+        from django.core.cache import cache
+        cache.set(self.key_prefix + key, value, self.timeout)
+
+
+def make_entry(results, spell_suggestion=None, facets=False):
+    """Extract what we want to cache from a Xappy ``SearchResults``
+    object.
+    """
+    entry = {
+        'hits': [(hit.id, hit.rank, hit.weight, hit.percent, hit.data)
+                 for hit in results],
+        'spell_suggestion': spell_suggestion,
+        'facets': facets and results.get_suggested_facets() or None,
+    }
+    for name in CachedSearchResults.counts:
+        entry[name] = getattr(results, name)
+    return entry
+
+
+class CachedSearchResult(object):
+    """Stands in for a Xappy ``SearchResult`` of a cached search.
+
+    Provides the id, ranking information and stored data of the hit.
+    Highlighting and summarising requires the actual search to be run,
+    which is done when needed.
+    """
+
+    def __init__(self, results, index, id, rank, weight, percent, data):
+        self._results = results
+        self._index = index
+        self.id = id
+        self.rank = rank
+        self.weight = weight
+        self.percent = percent
+        self.data = data
+
+    def _real(self):
+        return self._results._real().get_hit(self._index)
+
+    def highlight(self, *args, **kwargs):
+        return self._real().highlight(*args, **kwargs)
+
+    def summarise(self, *args, **kwargs):
+        return self._real().summarise(*args, **kwargs)
+
+
+class CachedSearchResults(object):
+    """Stands in for a Xappy ``SearchResults`` object, based on a cache
+    entry.
+
+    ``rerun`` is a callable that runs the actual search; this happens
+    only when information is requested that was not cached.
+    """
+
+    counts = ('matches_estimated', 'matches_lower_bound',
+              'matches_upper_bound', 'matches_human_readable_estimate',
+              'estimate_is_exact',)
+
+    def __init__(self, entry, conn, rerun):
+        self._entry = entry
+        self._conn = conn
+        self._rerun = rerun
+        self._real_results = None
+        for name in self.counts:
+            setattr(self, name, entry[name])
+
+    def _real(self):
+        if self._real_results is None:
+            self._real_results = self._rerun()
+        return self._real_results
+
+    def get_hit(self, index):
+        return CachedSearchResult(self, index, *self._entry['hits'][index])
+    __getitem__ = get_hit
+
+    def __iter__(self):
+        for index in range(len(self._entry['hits'])):
+            yield self.get_hit(index)
+
+    def __len__(self):
+        return len(self._entry['hits'])
+
+    def get_suggested_facets(self, *args, **kwargs):
+        if self._entry['facets'] is not None and not (args or kwargs):
+            return self._entry['facets']
+        return self._real().get_suggested_facets(*args, **kwargs)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._real(), name)
@@ -0,0 +1,142 @@
+"""Reuse of search connections across requests.
+
+Opening a Xapian database for every request that searches adds latency
+and causes a lot of file descriptor churn. Instead, ``Index`` instances
+get their ``SearchConnection`` from the process-wide ``searcher_pool``,
+which keeps connections open between requests.
+
+Xapian database objects must not be used by multiple threads at the
+same time, so the pool keeps a separate connection per thread (and
+index location). Before handing out a connection, the pool checks
+cheaply whether the database on disk has changed, and if so, reopens
+the connection to see the latest revision. If the index was replaced
+altogether (e.g. by a rebuild), a new connection is opened.
+"""
+
+import os
+import threading
+import weakref
+
+import xappy
+
+import shards as sharding
+
+
+__all__ = ('SearchConnectionPool', 'searcher_pool',)
+
+
+def _signature(location, shards=None):
+    """Return a tuple describing the state of the database at
+    ``location``, or ``None`` if it doesn't exist.
+
+    The first part identifies the database directory itself, and will
+    change if the index is replaced, e.g. when a rebuild switches the
+    symbolic link at ``location`` to a new generation. The last part
+    changes whenever changes are flushed to the database, since Xapian
+    renames new versions of it's files into place on every commit,
+    which updates the modification time of the directory.
+    """
+    try:
+        stat = os.stat(location)
+        if shards:
+            mtimes = [os.stat(sharding.shard_location(location, shard)).st_mtime
+                      for shard in range(shards)]
+        else:
+            mtimes = [stat.st_mtime]
+    except OSError:
+        return None
+    return (os.path.realpath(location), stat.st_ino), max(mtimes)
+
+
+class SearchConnectionPool(object):
+    """Keeps open search connections, one per index location and thread.
+    """
+
+    def __init__(self):
+        self._local = threading.local()
+        # All connections in all threads, so they can be closed. Only
+        # weak references are kept: when a thread exits, it's storage
+        # goes away, and it's connections are closed as they are
+        # garbage collected.
+        self._lock = threading.Lock()
+        self._all = weakref.WeakKeyDictionary()
+
+    def _connections(self):
+        try:
+            return self._local.connections
+        except AttributeError:
+            self._local.connections = {}
+            return self._local.connections
+
+    def _open(self, location, shards=None):
+        if shards:
+            connection = sharding.connect_searcher(location, shards)
+        else:
+            connection = xappy.SearchConnection(location)
+        self._lock.acquire()
+        try:
+            self._all[connection] = True
+        finally:
+            self._lock.release()
+        return connection
+
+    def _discard(self, connection):
+        self._lock.acquire()
+        try:
+            self._all.pop(connection, None)
+        finally:
+            self._lock.release()
+        connection.close()
+
+    def get(self, location, shards=None):
+        """Return an open search connection to the index at
+        ``location``, reflecting the latest flushed revision.
+
+        The connection must only be used by the calling thread.
+        """
+        connections = self._connections()
+        signature = _signature(location, shards)
+        try:
+            connection, old_signature = connections[location]
+        except KeyError:
+            connection = self._open(location, shards)
+        else:
+            if signature is None:
+                # the index is currently missing (e.g. in the middle
+                # of being replaced); keep using what we have.
+                return connection
+            elif old_signature is None or signature[0] != old_signature[0]:
+                # the index was replaced; the old connection still
+                # sees the old files, so we need a new connection.
+                self._discard(connection)
+                connection = self._open(location, shards)
+            elif signature != old_signature:
+                connection.reopen()
+        connections[location] = (connection, signature)
+        return connection
+
+    def close(self, location=None):
+        """Close the connection for ``location`` in the current thread,
+        or all connections of the current thread.
+        """
+        connections = self._connections()
+        for key in connections.keys():
+            if location is None or key == location:
+                self._discard(connections.pop(key)[0])
+
+    def close_all(self):
+        """Close all connections in all threads.
+
+        Only call this if no other threads are currently searching.
+        """
+        self._lock.acquire()
+        try:
+            all, self._all = self._all.keys(), weakref.WeakKeyDictionary()
+        finally:
+            self._lock.release()
+        for connection in all:
+            connection.close()
+        self._local = threading.local()
+
+
+searcher_pool = SearchConnectionPool()
@@ -1,21 +1,54 @@
 ﻿import time
 import types
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
 
 from django.db import models
 from django.db.models import Model
 from django.db.models.query import QuerySet
+from django.core.exceptions import ObjectDoesNotExist
 from django.utils.safestring import mark_safe
 from django.contrib.contenttypes.models import ContentType
+import xapian
 import xappy
-import xappy.searchconnection
 
 from models import log_model, Change
-from utils import template_callable
+from utils import template_callable, chunked_queryset
+from connections import searcher_pool
+from cache import REVISION_KEY, CachedSearchResults, \
+    make_entry as make_cache_entry, make_key as make_cache_key
+import shards as sharding
 
 
 __all__ = ('action', 'Index', 'FieldActions', 'OP_AND', 'OP_OR')
 
 
+# Counts how often searches had to be repeated because the index was
+# modified while we were reading from it ("retries"), and how often we
+# gave up doing so ("failures"). Useful for monitoring.
+search_stats = {'retries': 0, 'failures': 0}
+
+
+# the index metadata key storing the hash of a document; see
+# ``Index.skip_unchanged``.
+HASH_KEY = 'django_xappy.hash.%s'
+
+
+def document_hash(document):
+    """Return a hash of the field values of an ``UnprocessedDocument``.
+    """
+    hash = md5()
+    for field in document.fields:
+        value = field.value
+        if isinstance(value, unicode):
+            value = value.encode('utf8')
+        hash.update('%s\0%s\0' % (field.name, value))
+    # half of the digest is plenty to detect changes
+    return hash.digest()[:8]
+
+
 # make available here so user's don't have to import from xappy
 # TODO: should probably be moved to __init__
 from xappy import FieldActions
@@ -86,27 +119,91 @@ class IndexDataBase(object):
     Is injected automatically by ``IndexMetaclass``.
     """
 
+    # compiled by ``IndexMetaclass`` via ``compile_fields()``
+    _fields = ()
+
+    # Loading hints, per model (model -> tuple of lookups/field names).
+    # Applied to the querysets used to load the objects to be indexed,
+    # see ``Index.get_queryset``.
+    select_related = {}
+    prefetch_related = {}
+    only = {}
+    defer = {}
+
     @classmethod
-    def get_fields(cls):
-        """Return the fields defined by this data class (as their name).
+    def compile_fields(cls):
+        """Inspect the data class and return the "field plan" that the
+        indexing code works from, as a tuple of 3-tuples:
+
+            (name, function, actions)
+
+        ``function`` is the plain function defining the field, and
+        ``actions`` a tuple of normalized ``(fieldtype, kwargs)`` pairs,
+        with the django-xappy specific arguments (like ``truncate``)
+        already removed, so they can be passed on to Xappy as is.
+
+        This is the expensive ``dir()``-based introspection; it only
+        needs to run once per index class.
         """
+        plan = []
         for name in dir(cls):
             obj = getattr(cls, name)
             # only methods with at least one action are considered fields
-            if isinstance(obj, types.MethodType):
-                if len(getattr(obj.im_func, '_actions', {})) > 0:
-                    yield name
+            if not isinstance(obj, types.MethodType):
+                continue
+            raw_actions = getattr(obj.im_func, '_actions', {})
+            if not len(raw_actions) > 0:
+                continue
+
+            actions = []
+            for action in raw_actions.items():
+                # normalize the action object, can be given in
+                # different ways depending on what data is needed
+                if not isinstance(action, tuple):
+                    fieldtype, kwargs = action, {}
+                elif len(action) == 1:
+                    fieldtype, kwargs = action[0], {}
+                else:
+                    fieldtype, kwargs = action
+
+                # remove django-xappy specific arguments
+                kwargs = kwargs.copy()
+                if fieldtype == FieldActions.INDEX_EXACT:
+                    kwargs.pop('truncate', None)
+                actions.append((fieldtype, kwargs))
+
+            plan.append((name, obj.im_func, tuple(actions)))
+        return tuple(plan)
+
+    @classmethod
+    def get_fields(cls):
+        """Return the fields defined by this data class (as their name).
+        """
+        for name, func, actions in cls._fields:
+            yield name
 
     @classmethod
     def get_fieldactions(cls):
         """Return all actions defined by this class, together with
         their respective field name.
         """
-        for name in cls.get_fields():
-            obj = getattr(cls, name)
-            for action in getattr(obj.im_func, '_actions').items():
+        for name, func, actions in cls._fields:
+            for action in actions:
                 yield name, action
 
+    @classmethod
+    def get_truncated_fields(cls):
+        """Return the names of all fields whose values are to be
+        truncated to the maximum term length: those that do not pass
+        ``truncate=False`` to their INDEX_EXACT action.
+
+        See ``Index._document_for_instance``.
+        """
+        for name, func, actions in cls._fields:
+            if func._actions.get(FieldActions.INDEX_EXACT, {}).\
+                    get('truncate', True):
+                yield name
+
     def __init__(self, content_object=None, content_type=None, object_id=None):
         """Create an instance of the proxy data class, wrapping around
         a model instance.
@@ -213,6 +310,12 @@ class IndexMetaclass(type):
             # inheriting from both the user's Data class and the base,
             # simulating direct inheritance quite well.
             attrs['Data'] = type("%sData"%name, (dataklass, IndexDataBase), {})
+            # introspect the fields only once, rather than for every
+            # single document that is indexed.
+            attrs['Data']._fields = attrs['Data'].compile_fields()
+            # every index has it's own set of models, starting with those
+            # of the index it is derived from, if any.
+            attrs['_models'] = dict(getattr(bases[0], '_models', {}))
 
         klass = type.__new__(cls, name, bases, attrs)
 
@@ -234,6 +337,41 @@ class Index(object):
 
     __metaclass__ = IndexMetaclass
 
+    # Split the index into this many separate databases below
+    # ``location``. Documents are assigned to a shard either by their
+    # model (``shard_by = 'content_type'``), or by a hash of their id
+    # (``shard_by = 'hash'``). Searches always cover all shards.
+    shards = None
+    shard_by = 'content_type'
+
+    # Flush policy: Changes to the index are flushed (and become visible
+    # to searchers) after ``flush_every`` documents have been written, or
+    # if ``flush_interval`` seconds have passed since the last flush,
+    # whichever comes first. By default, Xappy decides based on it's
+    # memory usage. Both may also be set on an index instance.
+    flush_every = None
+    flush_interval = None
+
+    # Whether search results are resolved to model instances right away;
+    # see ``search()``.
+    resolve_results = True
+
+    # Whether to get search connections from the process-wide pool (see
+    # ``django_xappy.connections``), rather than opening a new one for
+    # every instance.
+    pool_searchers = True
+
+    # How often to repeat a search if the index is modified while we are
+    # reading from it; see ``search_stats``.
+    max_search_retries = 3
+
+    # Cache search results using this backend, see ``django_xappy.cache``.
+    result_cache = None
+
+    # If enabled, a hash of each document is stored in the index, and
+    # writing a document that hashes the same as the existing one is
+    # skipped; useful if many changes don't affect any indexed field.
+    skip_unchanged = False
 
     ## Class-usage
 
@@ -279,11 +417,48 @@ class Index(object):
             return cls._models.keys()
         else:
             result = []
-            for model, queryset in cls._models.items():
-                result.append((model, queryset
-                                        if queryset else model.objects.all()))
+            for model in cls._models.keys():
+                result.append((model, cls.get_queryset(model)))
             return result
 
+    @classmethod
+    def get_queryset(cls, model):
+        """Return the queryset to load objects of ``model`` from for
+        indexing.
+
+        This is the queryset the model was registered with, or all
+        objects if there was no restriction, with the loading hints
+        defined by the ``Data`` class applied. Those allow you to avoid
+        running additional queries for every single document if your
+        fields follow relations or only need a few columns:
+
+            class Data:
+                select_related = {Book: ('author', 'category')}
+                defer = {Book: ('body_html',)}
+
+                @action(FieldActions.INDEX_EXACT)
+                def author(self):
+                    if self == Book:
+                        return self.content_object.author.name
+
+        ``select_related``, ``prefetch_related``, ``only`` and ``defer``
+        are supported, and passed to the queryset method of the same
+        name.
+        """
+        queryset = cls._models.get(model)
+        if queryset is None:
+            queryset = model.objects.all()
+        return cls._apply_load_hints(queryset)
+
+    @classmethod
+    def _apply_load_hints(cls, queryset):
+        model = queryset.model
+        for hint in ('select_related', 'prefetch_related', 'only', 'defer'):
+            args = getattr(cls.Data, hint).get(model)
+            if args:
+                queryset = getattr(queryset, hint)(*args)
+        return queryset
+
     @classmethod
     def is_reponsible(cls, change):
         """Determine whether the given ``change`` needs to be applied
@@ -321,49 +496,121 @@ class Index(object):
             else:
                 return True
 
+    @classmethod
+    def responsible_changes(cls, changes):
+        """Batch version of ``is_reponsible``: Determine how each of
+        the given ``changes`` needs to be applied to this index.
+
+        Returns a 2-tuple of lists ``(update, delete)``: The changes in
+        ``update`` refer to objects that need to be (re-)indexed; those
+        in ``delete`` to objects that need to be removed from the index.
+        The latter include changes to objects that are no longer part of
+        the queryset restriction their model was registered with. Changes
+        not relevant to this index are not returned at all.
+
+        Needs one query per restricted model, regardless of the number of
+        changes.
+        """
+        update, delete = [], []
+        by_type = {}
+        for change in changes:
+            if change.kind == Change.Kind.delete:
+                # see ``is_reponsible`` as to why this is always fine
+                # for models that are registered at all.
+                if change.content_type.model_class() in cls._models:
+                    delete.append(change)
+            else:
+                by_type.setdefault(change.content_type_id, []).append(change)
+
+        for type_changes in by_type.values():
+            model = type_changes[0].content_type.model_class()
+            try:
+                queryset = cls._models[model]
+            except KeyError:
+                continue
+            if not queryset:
+                update.extend(type_changes)
+                continue
+
+            # Objects outside of the restriction may still be in the
+            # index from before they changed, so remove them.
+            included = set(queryset.filter(
+                pk__in=[c.object_id for c in type_changes]).\
+                    values_list('pk', flat=True))
+            for change in type_changes:
+                if change.object_id in included:
+                    update.append(change)
+                else:
+                    delete.append(change)
+        return update, delete
+
 
     ## Instance-usage
 
-    def __init__(self, location=None):
+    def __init__(self, location=None, open_shards=None):
         """
         If ``location`` is not specified, the value will be inherited
         from the location specified when defining the index class.
+
+        For sharded indexes, ``open_shards`` may be a list of shard
+        numbers, and only those shards will be opened for writing.
         """
         if location:
             self.location = location
+        self.open_shards = open_shards
         self._indexer = None
+        self._prefix_lengths = None
+        self._unflushed = 0
+        self._last_flush = time.time()
         self._searcher = None
+        # number of document writes avoided due to ``skip_unchanged``
+        self.skipped = 0
 
     def _connect_searcher(self):
         if not self._searcher:
-            self._searcher = xappy.SearchConnection(self.location)
+            if self.pool_searchers:
+                self._searcher = searcher_pool.get(self.location, self.shards)
+            elif self.shards:
+                self._searcher = sharding.connect_searcher(self.location,
+                                                         self.shards)
+            else:
+                self._searcher = xappy.SearchConnection(self.location)
 
     def _connect_indexer(self):
         if not self._indexer:
-            self._indexer = xappy.IndexerConnection(self.location)
+            if self.shards:
+                self._indexer = sharding.ShardedIndexerConnection(
+                    self.location, self.shards, self.shard_by,
+                    only=self.open_shards)
+            else:
+                self._indexer = xappy.IndexerConnection(self.location)
 
             # First time the index is created, register fields and their
             # actions; The index is assumed to have been created if
             # there are no current field actions.
             if not self._indexer.get_fields_with_actions():
-                for field, action in self.Data.get_fieldactions():
-                    # normalize the action object, can be given in
-                    # different ways depending on what data is needed
-                    if not isinstance(action, tuple):
-                        fieldtype, kwargs = action, {}
-                    elif len(action) == 1:
-                        fieldtype, kwargs = action[0], {}
-                    else:
-                        fieldtype, kwargs = action
-
-                    # remove django-xappy specific arguments
-                    kwargs = kwargs.copy()
-                    if fieldtype == FieldActions.INDEX_EXACT:
-                        kwargs.pop('truncate', None)
-
+                for field, (fieldtype, kwargs) in self.Data.get_fieldactions():
                     self._indexer.add_field_action(
                         field, fieldtype, **kwargs)
 
+            # HACK!
+            # The prefix Xappy uses is part of the term and takes up some
+            # of the characters we can use for INDEX_EXACT values, but
+            # depending on the number of actions/fields defined (?), it's
+            # length varies. This is basically copied from
+            # ``xappy/datastructures.py:add_term`` and will tell us the
+            # prefix length for each field. The mappings are fixed once
+            # the field actions are registered, so we only need to ask
+            # once per connection. Fields that are only stored have no
+            # prefix, and no terms that could be too long.
+            self._prefix_lengths = {}
+            for field in self.Data.get_truncated_fields():
+                try:
+                    prefix = self._indexer._field_mappings.get_prefix(field)
+                except KeyError:
+                    continue
+                self._prefix_lengths[field] = len(prefix)
+
     # Make SearchConnection features available on this class.
     #
     # __getattr__ would we simplier (just a list of names), but no
@@ -408,12 +655,32 @@ class Index(object):
                 self._connect_searcher()
             return self._searcher.get_doccount()
 
+    def shard_for(self, document_id):
+        """Return the number of the shard the document with the given
+        id belongs to, or ``None`` if the index is not sharded.
+        """
+        if not self.shards:
+            return None
+        return sharding.shard_for(document_id, self.shards, self.shard_by)
+
+    def shard_for_model(self, model):
+        """Return the number of the shard that all documents of ``model``
+        belong to, or ``None`` if they may end up in any shard (or the
+        index is not sharded at all).
+        """
+        if not self.shards or self.shard_by != 'content_type':
+            return None
+        return sharding.shard_for_content_type(
+            ContentType.objects.get_for_model(model).pk, self.shards)
+
     def close(self):
         if self._indexer:
             self._indexer.close()
             self._indexer = None
         if self._searcher:
-            self._searcher.close()
+            # pooled connections are kept open for reuse
+            if not self.pool_searchers:
+                self._searcher.close()
             self._searcher = None
 
 
@@ -430,9 +697,12 @@ class Index(object):
         document = xappy.UnprocessedDocument()
         document.id = data.document_id()
 
-        for field in data.get_fields():
-            obj = getattr(data, field)
-            value = obj()
+        if self._prefix_lengths is None:
+            self._connect_indexer()
+        prefix_lengths = self._prefix_lengths
+        append = document.fields.append
+        for field, func, actions in data._fields:
+            value = func(data)
             if value is None:
                 # apparently not available for this object/model
                 continue
@@ -444,6 +714,16 @@ class Index(object):
             else:
                 iter_over = (value,)
 
+            # Xappy currently has a length restriction for INDEX_EXACT
+            # fields (max. 220 characters), due to term-length limits
+            # in Xapian itself. Since often, the data an index operates
+            # on can be pretty random, we try per default, as a
+            # convenience, to truncate overlong INDEX_EXACT strings.
+            # This can be disabled by passing the special argument
+            # ``truncate=False`` to the INDEX_EXACT action. See
+            # ``_connect_indexer`` for how the prefix length is determined.
+            prefix = prefix_lengths.get(field)
+
             for value in iter_over:
                 # we need an utf8-encoded string for xapian
                 if isinstance(value, unicode):
@@ -456,33 +736,14 @@ class Index(object):
                 elif isinstance(value, type(None)):
                     value = u""
 
-                # Xappy currently has a length restriction for INDEX_EXACT
-                # fields (max. 220 characters), due to term-length limits
-                # in Xapian itself. Since often, the data an index operates
-                # on can be pretty random, we try per default, as a
-                # convenience, to truncate overlong INDEX_EXACT strings.
-                # This can be disabled by passing the special argument
-                # ``truncate=False`` to the INDEX_EXACT action.
-                actions = getattr(obj, '_actions')
-                if isinstance(value, str) \
-                        and actions.get(FieldActions.INDEX_EXACT, {}).\
-                                    get('truncate', True):
-                    # HACK!
-                    # The prefix Xappy uses is part of the term and takes
-                    # up some of the characters we can use, but depending
-                    # on the number of actions/fields defined (?), it's
-                    # length varies.
-                    # This code is basically copied from
-                    # ``xappy/datastructures.py:add_term`` and will tell
-                    # tell us the prefix length for this field.
-                    prefix = len(self._indexer._field_mappings.get_prefix(field))
+                if prefix is not None and isinstance(value, str):
+                    maxlen = 220-prefix
                     if len(value) > 0:
-                        if ord(value[0]) >= ord('A') and ord(value[0]) <= ord('Z'):
-                            prefix += 1  # ':'
-
-                    value = value[:220-prefix]
+                        if 'A' <= value[0] <= 'Z':
+                            maxlen -= 1  # ':'
+                    value = value[:maxlen]
 
-                document.fields.append(xappy.Field(field, value))
+                append(xappy.Field(field, value))
 
         return document
 
@@ -494,17 +755,64 @@ class Index(object):
         """
         return self.update(instance)
 
-    def update(self, instances):
+    def update(self, instances, chunk_size=1000):
         """Update one or multiple documents in the index.
 
         Objects that do not yet exist exist as documents are added.
+
+        ``instances`` may be a single model instance, or any iterable
+        of them. It may also be a queryset, in which case the loading
+        hints of the ``Data`` class are applied (see ``get_queryset``),
+        and the objects are loaded ``chunk_size`` rows at a time.
+
+        Changes are flushed according to the index's flush policy (see
+        ``flush_every`` and ``flush_interval``). Returns the number of
+        documents written, which doesn't include those skipped because
+        they did not change (see ``skip_unchanged``).
         """
-        if not isinstance(instances, (list, tuple)):
+        if isinstance(instances, Model):
             instances = (instances,)
+        elif isinstance(instances, QuerySet):
+            instances = chunked_queryset(self._apply_load_hints(instances),
+                                         chunk_size)
 
         self._connect_indexer()
+        count = 0
         for instance in instances:
-            return self._indexer.replace(self._document_for_instance(instance))
+            if self.replace_document(self._document_for_instance(instance)):
+                count += 1
+        return count
+
+    def replace_document(self, document):
+        """Write an already built document to the index, replacing an
+        existing document with the same id.
+
+        Normally, you want to use ``update`` instead. This exists for
+        code that builds documents elsewhere, e.g. in another process
+        (see ``django_xappy.parallel``).
+
+        Returns ``False`` if the write was skipped because the document
+        did not change (see ``skip_unchanged``), ``True`` otherwise.
+        """
+        self._connect_indexer()
+        if self.skip_unchanged:
+            key, hash = HASH_KEY % document.id, document_hash(document)
+            connection = self._connection_for(document.id)
+            if connection.get_metadata(key) == hash:
+                self.skipped += 1
+                return False
+            connection.set_metadata(key, hash)
+        self._indexer.replace(document)
+        self._written()
+        return True
+
+    def _connection_for(self, document_id):
+        """Return the Xappy ``IndexerConnection`` the document with
+        the given id is stored in.
+        """
+        if self.shards:
+            return self._indexer._connection_for(document_id)
+        return self._indexer
 
     def delete(self, what, model=None, content_type=None):
         """Delete a document from the index.
@@ -528,18 +836,95 @@ class Index(object):
 
             doc = self.Data(content_type=content_type, object_id=what)
 
+        self._delete_document(doc.document_id())
+
+    def delete_all(self, model=None, content_type=None):
+        """Delete the documents of all objects of ``model`` (or the
+        given content type) from the index, and return their number.
+
+        The documents are found by their id, so this relies on the
+        default format (see ``IndexDataBase.document_id``).
+        """
+        assert model or content_type,\
+            "You need to specify either a model or a content type"
+        if not content_type:
+            content_type = ContentType.objects.get_for_model(model)
+        suffix = '-%d' % content_type.pk
+
+        self._connect_indexer()
+        # collect the ids first; we can't modify the database while
+        # iterating over it's terms.
+        ids = [id for id in self._indexer.iterids() if id.endswith(suffix)]
+        for id in ids:
+            self._delete_document(id)
+        return len(ids)
+
+    def _delete_document(self, document_id):
         self._connect_indexer()
-        self._indexer.delete(doc.document_id())
+        self._indexer.delete(document_id)
+        if self.skip_unchanged:
+            self._connection_for(document_id).set_metadata(
+                HASH_KEY % document_id, '')
+        self._written()
+
+    def _written(self):
+        """Called for every document written or deleted; flushes if
+        required by the flush policy.
+        """
+        self._unflushed += 1
+        if self.flush_every and self._unflushed >= self.flush_every:
+            self.flush()
+        elif self.flush_interval and \
+                time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
 
     def flush(self):
         if self._indexer:
+            if self._unflushed:
+                # lets searchers know that the index has changed,
+                # see ``result_cache``.
+                self._indexer.set_metadata(REVISION_KEY, repr(time.time()))
             self._indexer.flush()
+        self._unflushed = 0
+        self._last_flush = time.time()
 
 
     ## Searching
 
+    def _result_cache_key(self, query, page, num_per_page, kwargs):
+        """Return the key for the ``result_cache`` entry of a search.
+
+        Includes the index revision, which changes on every flush, so
+        that cache entries are invalidated once the index changes.
+        """
+        if isinstance(query, xappy.Query):
+            query = str(query)
+        kwargs = kwargs.items()
+        kwargs.sort()
+        return make_cache_key(self.location, query, page, num_per_page,
+                              kwargs, self._searcher.get_metadata(REVISION_KEY))
+
+    def _retry_if_modified(self, func, *args, **kwargs):
+        """Call ``func`` with the given arguments. If that fails because
+        the index was modified in the meantime (Xapian only guarantees
+        readers a consistent view of the latest and the previous
+        revision), reopen the search connection and try again, up to
+        ``max_search_retries`` times.
+        """
+        retries = 0
+        while True:
+            try:
+                return func(*args, **kwargs)
+            except xapian.DatabaseModifiedError:
+                if retries >= self.max_search_retries:
+                    search_stats['failures'] += 1
+                    raise
+                retries += 1
+                search_stats['retries'] += 1
+                self._searcher.reopen()
+
     def search(self, query, page=1, num_per_page=10, adjust_page=False,
-               query_str=None, **kwargs):
+               query_str=None, resolve=None, **kwargs):
         """Do a search for ``query``.
 
         ``query`` is a Google-syntax like search string, as supported
@@ -568,6 +953,15 @@ class Index(object):
         ``adjust_page`` argument to True, the result will a 2-tuple
         **(results, fixed_page_num)**.
 
+        Normally, the results are resolved to model instances right
+        away, which requires one database query per model on the page.
+        If you only output fields stored in the index (``STORE_CONTENT``),
+        you may pass ``resolve=False``, or set ``resolve_results = False``
+        on the index class, and no queries will be run at all, unless
+        you actually access a result's ``content_object``. Note that in
+        this mode, results whose objects no longer exist in the database
+        are not skipped.
+
         All other **kwargs will be passed on the Xappy's ``search``
         method. For example, you may use it to enable the ``getfacets``
         option.
@@ -578,38 +972,87 @@ class Index(object):
         start = (page-1)*num_per_page
         count = num_per_page
 
+        raw_query = query
         if not isinstance(query, xappy.Query):
             query_str = query
-            query = self._searcher.query_parse(query.encode('utf-8'))
 
-        _search = lambda s:\
-            self._searcher.search(query, s, s+count, **kwargs)
+        # parsing is deferred, so it can be skipped if the results are
+        # cached.
+        _parsed = []
+        def get_query():
+            if not _parsed:
+                if isinstance(raw_query, xappy.Query):
+                    _parsed.append(raw_query)
+                else:
+                    _parsed.append(self._searcher.query_parse(
+                        raw_query.encode('utf-8')))
+            return _parsed[0]
+
+        _search = lambda s: self._retry_if_modified(
+            self._searcher.search, get_query(), s, s+count, **kwargs)
+
+        def rerun():
+            # used by the results object to repeat the search
+            self._searcher.reopen()
+            return _search(start)
+
+        cache_key = entry = None
+        if self.result_cache is not None and not kwargs.get('gettags'):
+            cache_key = self._result_cache_key(raw_query, page, num_per_page,
+                                               kwargs)
+            entry = self.result_cache.get(cache_key)
 
-        # first, attempt a normal search
         ts_begin = time.time()
-        results = _search(start)
-
-        # Check for the case that a non-existant page number was
-        # requested, likely because we reported a too high result count
-        # in earlier searches. Handle gracefully and repeat the search
-        # to retrieve to last page of results.
-        #
-        # Note that this is only possible because now we DO have the
-        # exact number of hits, because Xapian went through the whole
-        # resultset on the search we just did.
-        if results.matches_estimated<start+1 and results.estimate_is_exact:
-            page = (results.matches_estimated/count)+1
-            start = (page-1)*num_per_page
+        if entry is not None:
+            page, start = entry['page'], entry['start']
+            results = CachedSearchResults(entry, self._searcher,
+                                          lambda: _search(start))
+        else:
+            # first, attempt a normal search
             results = _search(start)
 
+            # Check for the case that a non-existant page number was
+            # requested, likely because we reported a too high result count
+            # in earlier searches. Handle gracefully and repeat the search
+            # to retrieve to last page of results.
+            #
+            # Note that this is only possible because now we DO have the
+            # exact number of hits, because Xapian went through the whole
+            # resultset on the search we just did.
+            if results.matches_estimated<start+1 and results.estimate_is_exact:
+                page = (results.matches_estimated/count)+1
+                start = (page-1)*num_per_page
+                results = _search(start)
+
+            if cache_key is not None:
+                try:
+                    entry = make_cache_entry(results,
+                        facets=kwargs.get('getfacets'),
+                        spell_suggestion=query_str and
+                            spell_suggestion(self._searcher, query_str))
+                except xapian.DatabaseModifiedError:
+                    # don't bother, the next search will cache again
+                    pass
+                else:
+                    entry.update({'page': page, 'start': start})
+                    self.result_cache.set(cache_key, entry)
+
         search_time = time.time() - ts_begin
 
+        if resolve is None:
+            resolve = self.resolve_results
+
         results = XapianResults(
                     results,
                     offset=start,
                     num_per_page=num_per_page,
                     query=query_str,
-                    search_time=search_time)
+                    search_time=search_time,
+                    resolve=resolve,
+                    rerun=rerun,
+                    max_retries=self.max_search_retries)
+        if entry is not None and query_str:
+            results._spell_suggestion = entry['spell_suggestion']
 
         if adjust_page:
             return results, page
@@ -617,74 +1060,149 @@ class Index(object):
             return results
 
 
+def spell_suggestion(conn, query):
+    """Return the spell-corrected version of the unicode string
+    ``query``, or ``None`` if there are no corrections.
+    """
+    query_utf8 = query.encode('utf8')
+    suggested_query = conn.spell_correct(query_utf8)
+    return (suggested_query != query_utf8 and
+                [suggested_query.decode('utf-8')] or
+                [None])[0]
+
+
 class XapianResults(object):
     """A thin wrapper around the ``SearchResults`` object returned
     by Xappy, exposing the functionality we care about most, and
     also wrapping each result in a ``XapianResult`` class.
     """
 
-    def __init__(self, results, offset, num_per_page, query, search_time=None):
+    def __init__(self, results, offset, num_per_page, query, search_time=None,
+                 resolve=True, rerun=None, max_retries=3):
         """
         The number in ``offset`` specifies the first index of the
         search results, 0-based (e.g. for results 31-40, offset
         will be 30).
+
+        If ``resolve`` is disabled, the results are not resolved to
+        model instances up front; see ``Index.search``.
+
+        ``rerun`` may be a callable that reopens the index and repeats
+        the search, returning new Xappy results. It is used (at most
+        ``max_retries`` times) if the index is modified while we are
+        reading the hits.
         """
         self._results = results
+        self._rerun = rerun
+        self.max_retries = max_retries
         self.offset = offset
         self.num_per_page = num_per_page
         self.query = query
         self.search_time = search_time
+        self.resolve = resolve
+        self._resolved = None
 
     def _mkresult(self, index):
-        """Wrap a xappy search result with our own custom class.
+        """Return the wrapped search result at the 0-based position
+        ``index`` on the current page, or ``False`` if the result could
+        not be resolved to a model instance (see ``_resolve``).
+        """
+        if index < 0:
+            raise IndexError(index)
+        return self._resolve()[index]
+
+    def _resolve(self):
+        """Wrap the xappy search results on the current page with our
+        own custom class.
 
         In addition, this method serves two important functions:
 
         Firstly, it resolves each search results to a model instance,
         which it makes available via the ``content_object`` attribute.
+        Rather than querying for each result individually, the results
+        are grouped by content type, and each group is then loaded with
+        a single query.
 
         Also, this is the place were we handle sync issues between the
         database and the search index - an object might already be
         deleted from the database while the index has not yet been
         updated. Our current solution is just to ignore that and return
-        ``False``, so the caller may simply skip the result, and display
-        a result page actually containing less items than advertised.
+        ``False`` in place of the result, so the caller may simply skip
+        the result, and display a result page actually containing less
+        items than advertised.
 
-        ``index`` is normally the 0-based index to be used with
-        ``get_hit``, but can also be an already retrieved
-        ``SearchResult`` object.
+        The resolved results are cached, so this only happens once.
 
-        # TODO: get all content_object of same type instances at once
-        # TODO: cache the XapianResult instances?
+        If resolving is disabled, the results are simply wrapped, and
+        each result will load it's model instance only if it's
+        ``content_object`` attribute is accessed.
         """
+        if self._resolved is not None:
+            return self._resolved
+
+        if not self.resolve:
+            self._resolved = [XapianResult(r) for r in self._fetch_hits()]
+            return self._resolved
+
+        hits = []
+        ids_by_type = {}
+        for result in self._fetch_hits():
+            object_id, content_type_id = map(int, result.id.split('-'))
+            hits.append((result, content_type_id, object_id))
+            ids_by_type.setdefault(content_type_id, []).append(object_id)
+
+        objects = {}
+        for content_type_id, object_ids in ids_by_type.items():
+            # uses the content type cache, so usually doesn't query
+            try:
+                content_type = ContentType.objects.get_for_id(content_type_id)
+            except ContentType.DoesNotExist:
+                continue
+            model = content_type.model_class()
+            if model is None:
+                # the model does no longer exist
+                continue
+            for pk, obj in model._default_manager.in_bulk(object_ids).items():
+                objects[(content_type_id, pk)] = obj
+
+        self._resolved = []
+        for result, content_type_id, object_id in hits:
+            content_object = objects.get((content_type_id, object_id))
+            if content_object is None:
+                self._resolved.append(False)
+            else:
+                self._resolved.append(XapianResult(result, content_object))
+        return self._resolved
 
-        if isinstance(index, xappy.searchconnection.SearchResult):
-            result = index
-        else:
-            # TODO: DatabaseModifiedError error may occur here. can we
-            # handle it, and is it worth it (since this xapian limitation
-            # may go away)? See also the "Concurrent update limitations"
-            # section in introduction.rst of the xappy docs.
-            result = self._results.get_hit(index)
+    def _fetch_hits(self):
+        """Read all hits on the current page from the index, including
+        their stored data, and return them as a list.
 
-        object_id, content_type_id = result.id.split('-')
-        # 1) query content type
-        try:
-            content_type = ContentType.objects.get(pk=content_type_id)
-        except ContentType.DoesNotExist:
-            return False
-        else:
-            # 2) query model instance
+        This is where ``DatabaseModifiedError`` may occur, if the index
+        was modified since we ran the search (see also the "Concurrent
+        update limitations" section in introduction.rst of the xappy
+        docs). If so, we repeat the search and start over.
+        """
+        retries = 0
+        while True:
             try:
-                content_object = content_type.get_object_for_this_type(pk=object_id)
-            except content_type.model_class().DoesNotExist:
-                return False
-            else:
-                return XapianResult(result, content_object)
+                hits = []
+                for result in self._results:
+                    # load everything from the database now, while we
+                    # are still able to recover.
+                    result.id, result.data
+                    hits.append(result)
+                return hits
+            except xapian.DatabaseModifiedError:
+                if not self._rerun or retries >= self.max_retries:
+                    search_stats['failures'] += 1
+                    raise
+                retries += 1
+                search_stats['retries'] += 1
+                self._results = self._rerun()
 
     def __iter__(self):
-        for result in self._results:
-            yield self._mkresult(result)
+        return iter(self._resolve())
 
     def __getitem__(self, key):
         """Allow direct access to search results, even slice based.
@@ -738,11 +1256,8 @@ class XapianResults(object):
                 '"query_str" to search()')
 
         if not hasattr(self, '_spell_suggestion'):
-            query_utf8 = self.query.encode('utf8')
-            suggested_query = self._results._conn.spell_correct(query_utf8)
-            self._spell_suggestion = (suggested_query != query_utf8 and
-                                        [suggested_query.decode('utf-8')] or
-                                        [None])[0]
+            self._spell_suggestion = spell_suggestion(self._results._conn,
+                                                      self.query)
         return self._spell_suggestion
 
     @property
@@ -784,9 +1299,38 @@ class XapianResult(object):
     Provides certain functions we'd like to use in templates.
     """
 
-    def __init__(self, result, content_object):
+    def __init__(self, result, content_object=None):
+        """
+        If ``content_object`` is not given, it will be loaded from the
+        database when it is first accessed.
+        """
         self._result = result
-        self.content_object = content_object
+        self._content_object = content_object
+        self._content_object_loaded = content_object is not None
+        object_id, content_type_id = result.id.split('-')
+        self.object_id, self.content_type_id = \
+            int(object_id), int(content_type_id)
+
+    @property
+    def content_type(self):
+        # uses the content type cache, so usually doesn't query
+        return ContentType.objects.get_for_id(self.content_type_id)
+
+    @property
+    def content_object(self):
+        """The model instance this result represents.
+
+        Is ``None`` if the object does no longer exist.
+        """
+        if not self._content_object_loaded:
+            try:
+                self._content_object = \
+                    self.content_type.get_object_for_this_type(
+                        pk=self.object_id)
+            except ObjectDoesNotExist:
+                pass
+            self._content_object_loaded = True
+        return self._content_object
 
     def __getattr__(self, name):
         try:
@@ -824,5 +1368,6 @@ class XapianResult(object):
 
             {% ifequal result.model "user" %}
 
+        Does not require the model instance to be loaded.
         """
-        return type(self.content_object).__name__.lower()
\ No newline at end of file
+        return self.content_type.model_class().__name__.lower()
\ No newline at end of file
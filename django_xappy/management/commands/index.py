@@ -12,11 +12,69 @@ class Command(BaseCommand):
                  'format or the app\'s search code itself, e.g. add new '
                  'fields, add new models to be indexed etc.'),
 
+        make_option('--resume', action='store_true',
+            dest='resume', default=False,
+            help='With --full-rebuild, continue an interrupted rebuild '
+                 'where it stopped.'),
+
+        make_option('--model', action='append',
+            dest='models', default=[],
+            help='With --full-rebuild, only rebuild the documents of this '
+                 'model (given as app_label.ModelName), in the live '
+                 'index. May be given multiple times.'),
+
         make_option('--update', action='store_true',
             dest='update', default=None,
             help='Handle changed records since last update. '
                  'This brings the index up-to-date with the changes '
                  'flagged in the database.'),
+
+        make_option('--daemon', action='store_true',
+            dest='daemon', default=None,
+            help='Keep running, and apply changes continuously as they '
+                 'are logged. Stop with SIGTERM.'),
+
+        make_option('--reconcile', action='store_true',
+            dest='reconcile', default=None,
+            help='Compare the index with the database, and log changes '
+                 'for all differences found. They are applied by the '
+                 'next update.'),
+
+        make_option('--check-hashes', action='store_true',
+            dest='check_hashes', default=False,
+            help='With --reconcile, also find documents that are out of '
+                 'date. Requires the index to use skip_unchanged.'),
+
+        make_option('--latency', action='store', type='float',
+            dest='latency', default=2.0,
+            help='With --daemon, flush applied changes after at most this '
+                 'many seconds (default: 2).'),
+
+        make_option('--index', action='append',
+            dest='indexes', default=[],
+            help='Only update or rebuild the index with the given class '
+                 'name. May be given multiple times.'),
+
+        make_option('--chunk-size', action='store', type='int',
+            dest='chunk_size', default=None,
+            help='Number of objects (or changes, during an update) to '
+                 'load from the database at once (default: %d, or %d '
+                 'with --daemon).' % (update.DEFAULT_CHUNK_SIZE,
+                                      update.DAEMON_CHUNK_SIZE)),
+
+        make_option('--workers', action='store', type='int',
+            dest='workers', default=None,
+            help='Build the documents in this many processes in '
+                 'parallel. Not supported with --daemon.'),
+
+        make_option('--flush-every', action='store', type='int',
+            dest='flush_every', default=None,
+            help='Flush changes to the index after this many documents.'),
+
+        make_option('--flush-interval', action='store', type='float',
+            dest='flush_interval', default=None,
+            help='Flush changes to the index at least every this many '
+                 'seconds.'),
     )
     help = "Update the search index."
 
@@ -27,10 +85,46 @@ class Command(BaseCommand):
         elif verbosity < 1:
             update.log.setLevel(logging.WARNING)
 
+        try:
+            indexes = update.find_indexes(options.get('indexes') or [])
+            models = update.find_models(options.get('models') or [])
+        except ValueError, e:
+            raise CommandError(e)
+
+        chunk_size = options.get('chunk_size')
+        if chunk_size is not None and chunk_size < 1:
+            raise CommandError("--chunk-size needs to be at least 1")
+
+        if options.get('daemon') and not (options.get('rebuild') or
+                                          options.get('reconcile')):
+            if options.get('workers'):
+                raise CommandError("--workers is not supported with "
+                    "--daemon")
+            if chunk_size is None:
+                chunk_size = update.DAEMON_CHUNK_SIZE
+            update.run_daemon(indexes, latency=options.get('latency'),
+                              chunk_size=chunk_size)
+            return
+        if chunk_size is None:
+            chunk_size = update.DEFAULT_CHUNK_SIZE
+
+        flush_policy = {'flush_every': options.get('flush_every'),
+                        'flush_interval': options.get('flush_interval')}
         if options.get('rebuild'):
-            update.rebuild(clear_changes=True)
+            update.rebuild(indexes, clear_changes=True,
+                           chunk_size=chunk_size,
+                           workers=options.get('workers'),
+                           resume=options.get('resume'),
+                           models=models,
+                           **flush_policy)
+        elif options.get('reconcile'):
+            update.reconcile(indexes, chunk_size=chunk_size,
+                             check_hashes=options.get('check_hashes'))
         elif options.get('update'):
-            update.apply_changes()
+            update.apply_changes(indexes,
+                                 chunk_size=chunk_size,
+                                 workers=options.get('workers'),
+                                 **flush_policy)
         else:
-            raise CommandError("You need to specify either --update or "
-                "--full-rebuild")
\ No newline at end of file
+            raise CommandError("You need to specify either --update, "
+                "--daemon, --reconcile or --full-rebuild")
\ No newline at end of file
@@ -0,0 +1,34 @@
+from models import start_buffering, stop_buffering
+
+
+__all__ = ('ChangeLogMiddleware',)
+
+
+class ChangeLogMiddleware(object):
+    """Buffers the model changes logged during a request, and writes
+    them at once when the response is returned. If the view raises an
+    exception, the changes are discarded.
+
+    When using ``TransactionMiddleware``, list this middleware after
+    it, so that the changes are written as part of the request's
+    transaction, and discarded when it is rolled back.
+    """
+
+    def process_request(self, request):
+        # If a response middleware running before ours raised, our
+        # ``process_response`` was skipped, and the scope of that request
+        # is still open on this thread. Nesting in it would mean that
+        # nothing is written anymore, so we start over.
+        start_buffering(reset=True)
+        request._xappy_buffering = True
+
+    def process_response(self, request, response):
+        if getattr(request, '_xappy_buffering', False):
+            request._xappy_buffering = False
+            stop_buffering()
+        return response
+
+    def process_exception(self, request, exception):
+        if getattr(request, '_xappy_buffering', False):
+            request._xappy_buffering = False
+            stop_buffering(write=False)
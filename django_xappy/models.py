@@ -1,9 +1,22 @@
 import datetime
-from django.db import models
+import threading
+import warnings
+from django.db import models, connection, transaction, IntegrityError
 from django.contrib.contenttypes.models import ContentType
 from django.db.models import signals
 
 
+# Seconds within which the transaction that logged a change is assumed to
+# have been committed. Changes do not necessarily become visible in the
+# order of their ids, so indexes only consider all changes up to an id
+# applied once it is that old (see ``ChangeManager.settled_id``).
+VISIBILITY_LAG = 60
+
+# Whether the change log table still has the unique index on the object
+# that older versions created; see ``ChangeManager._replace``.
+_unique_index = False
+
+
 class ChangeManager(models.Manager):
     def get_query_set(self):
         # We are trying to apply change changes in the order they
@@ -26,14 +39,203 @@ class ChangeManager(models.Manager):
         return self.get_query_set().filter(timestamp__lt=dt)
 
     def log(self, kind, instance):
-        change, created = self.get_or_create(
-            content_type=ContentType.objects.get_for_model(instance),
-            object_id=instance.pk,
-            defaults={'kind': kind})
-        if not created:
-            change.kind = kind
-            change.timestamp = datetime.datetime.now()
-            change.save()
+        content_type = ContentType.objects.get_for_model(instance)
+        if is_buffering():
+            # a later change to the same object supersedes earlier ones
+            _buffer.changes[(content_type.pk, instance.pk)] = kind
+            return
+
+        # Rather than updating an existing entry for the object, replace
+        # it, so that the change gets a new id: indexes keep track of
+        # the changes they have already seen by id.
+        def insert():
+            self.create(content_type=content_type, object_id=instance.pk,
+                        kind=kind)
+        def delete(up_to):
+            entries = self.filter(content_type=content_type,
+                                  object_id=instance.pk)
+            if up_to is not None:
+                entries = entries.filter(id__lte=up_to)
+            entries.delete()
+        self._replace(insert, delete)
+
+    def _replace(self, insert, delete, using=None):
+        """Add new log entries by calling ``insert``, and remove the
+        entries they replace by calling ``delete``.
+
+        The new entries are added first, so that the most recent entry
+        is never deleted (see ``remove_applied``); ``delete`` is passed
+        the id of the last entry that existed before, so it doesn't
+        remove the new ones. Tables created by older versions have a
+        unique index on the object, and require the old entries to be
+        deleted first; ``delete`` is then passed ``None``.
+
+        ``using`` is the alias of the database the entries are written
+        to, if not the default one.
+        """
+        global _unique_index
+        if not _unique_index:
+            kwargs = using and {'using': using} or {}
+            manager = using and self.db_manager(using) or self
+            replaced = manager.last_id()
+            sid = transaction.savepoint(**kwargs)
+            try:
+                insert()
+            except IntegrityError:
+                transaction.savepoint_rollback(sid, **kwargs)
+                _unique_index = True
+                warnings.warn('The table %s still has a unique index on '
+                    '(content_type_id, object_id); drop it, otherwise '
+                    'changes may be missed by the indexes.' % \
+                        self.model._meta.db_table)
+            else:
+                transaction.savepoint_commit(sid, **kwargs)
+                delete(replaced)
+                return
+        delete(None)
+        insert()
+
+    def last_id(self):
+        """Return the id of the most recent change, or 0.
+        """
+        ids = self.values_list('id', flat=True).order_by('-id')[:1]
+        return ids and ids[0] or 0
+
+    def settled_id(self, lag=VISIBILITY_LAG):
+        """Return the id of the most recent change logged at least
+        ``lag`` seconds ago, or 0.
+
+        A change logged before it, but by a transaction that was still
+        running, may only show up after more recent changes; all changes
+        up to the returned id can be assumed to be visible by now.
+        """
+        cutoff = datetime.datetime.now() - datetime.timedelta(seconds=lag)
+        ids = self.values_list('id', flat=True).\
+            filter(timestamp__lt=cutoff).order_by('-id')[:1]
+        return ids and ids[0] or 0
+
+    def remove_applied(self, position):
+        """Delete all changes up to and including the id ``position``
+        from the log, with a single query.
+
+        The most recent change is always kept: some databases (SQLite,
+        MySQL before 8.0 after a restart) reuse the ids of deleted rows
+        at the end of a table, and a change getting an id that indexes
+        have already moved past would never be applied.
+        """
+        position = min(position, self.last_id() - 1)
+        qn = connection.ops.quote_name
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM %s WHERE %s <= %%s' % (
+            qn(self.model._meta.db_table), qn('id')), [position])
+        transaction.commit_unless_managed()
+
+    def log_many(self, changes):
+        """Log multiple changes at once, given as a dict mapping
+        ``(content_type_id, object_id)`` tuples to the change kind.
+
+        Existing log entries for those objects are replaced. Needs a
+        handful of queries, regardless of the number of changes.
+        """
+        if not changes:
+            return
+        qn = connection.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        ct_column = qn(self.model._meta.get_field('content_type').column)
+        cursor = connection.cursor()
+
+        now = connection.ops.value_to_db_datetime(datetime.datetime.now())
+        rows = changes.items()
+        def insert():
+            # a single statement per chunk; ``executemany`` runs one per
+            # row with some backends.
+            for i in range(0, len(rows), 200):
+                chunk = rows[i:i+200]
+                params = []
+                for (content_type_id, object_id), kind in chunk:
+                    params.extend([content_type_id, object_id, kind, now])
+                cursor.execute('INSERT INTO %s (%s, %s, %s, %s) VALUES %s' % (
+                    table, ct_column, qn('object_id'), qn('kind'),
+                    qn('timestamp'),
+                    ', '.join(['(%s, %s, %s, %s)'] * len(chunk))), params)
+
+        by_type = {}
+        for content_type_id, object_id in changes:
+            by_type.setdefault(content_type_id, []).append(object_id)
+        def delete(up_to):
+            for content_type_id, object_ids in by_type.items():
+                # keep the number of parameters per query in check
+                for i in range(0, len(object_ids), 500):
+                    chunk = object_ids[i:i+500]
+                    sql, params = _object_filter(
+                        ct_column, qn('object_id'), chunk, up_to)
+                    cursor.execute('DELETE FROM %s WHERE %s' % (table, sql),
+                                   [content_type_id] + params)
+
+        self._replace(insert, delete)
+        transaction.commit_unless_managed()
+
+    def log_bulk(self, queryset, kind=None):
+        """Log a change of ``kind`` (an update by default) for every
+        object in ``queryset``.
+
+        Use this after changes that don't send any signals, like
+        ``QuerySet.update()``, bulk inserts or raw SQL - for deletions,
+        before the objects are deleted. The log entries are written by
+        the database server, without loading the objects, so the change
+        log needs to be in the same database as the objects.
+        """
+        if kind is None:
+            kind = Change.Kind.update
+        model = queryset.model
+        if queryset.query.low_mark or queryset.query.high_mark is not None:
+            # the objects are selected by a subquery, which would be run
+            # more than once, and MySQL doesn't support LIMIT in those.
+            raise ValueError('log_bulk() does not support sliced '
+                'querysets; filter them by primary key instead.')
+
+        # with model inheritance, the primary key of a subclass instance
+        # is the same as the one of it's parent.
+        targets = [m for m in _LOGGED_MODELS if issubclass(model, m)] or \
+            [model]
+
+        query = queryset.values_list('pk', flat=True).order_by().query
+        if hasattr(query, 'get_compiler'):
+            # multiple databases are supported: use the one of ``queryset``
+            from django.db import connections
+            using = queryset.db
+            db = connections[using]
+            select, select_params = query.get_compiler(using).as_sql()
+        else:
+            using, db = None, connection
+            select, select_params = query.as_sql()
+
+        qn = db.ops.quote_name
+        table = qn(self.model._meta.db_table)
+        ct_column = qn(self.model._meta.get_field('content_type').column)
+        pk_column = qn(model._meta.pk.column)
+        now = db.ops.value_to_db_datetime(datetime.datetime.now())
+        cursor = db.cursor()
+        content_type_ids = [ContentType.objects.get_for_model(target).pk
+                            for target in targets]
+        def insert():
+            for content_type_id in content_type_ids:
+                cursor.execute('INSERT INTO %s (%s, %s, %s, %s) '
+                    'SELECT %%s, %s, %%s, %%s FROM (%s) %s' % (
+                        table, ct_column, qn('object_id'), qn('kind'),
+                        qn('timestamp'), pk_column, select, qn('changed')),
+                    [content_type_id, kind, now] + list(select_params))
+        def delete(up_to):
+            for content_type_id in content_type_ids:
+                sql, params = _object_filter(
+                    ct_column, qn('object_id'), select, up_to, qn)
+                cursor.execute('DELETE FROM %s WHERE %s' % (table, sql),
+                    [content_type_id] + list(select_params) + params)
+        self._replace(insert, delete, using)
+        if using:
+            transaction.commit_unless_managed(using=using)
+        else:
+            transaction.commit_unless_managed()
 
     def log_delete(self, instance):
         self.log(Change.Kind.delete, instance)
@@ -45,6 +247,22 @@ class ChangeManager(models.Manager):
         self.log(Change.Kind.update, instance)
 
 
+def _object_filter(ct_column, object_column, objects, up_to=None, qn=None):
+    """Return the WHERE clause selecting the log entries of a content
+    type (the first parameter) and ``objects`` (a list of ids, or a
+    subquery), up to the id ``up_to``, with it's parameters.
+    """
+    if not isinstance(objects, basestring):
+        objects, params = ', '.join(['%s'] * len(objects)), list(objects)
+    else:
+        params = []
+    sql = '%s = %%s AND %s IN (%s)' % (ct_column, object_column, objects)
+    if up_to is not None:
+        sql += ' AND %s <= %%s' % (qn or connection.ops.quote_name)('id')
+        params.append(up_to)
+    return sql, params
+
+
 class Change(models.Model):
     """Logs changes to all models that are searchable.
 
@@ -58,7 +276,7 @@ class Change(models.Model):
         delete = 3
 
     content_type = models.ForeignKey(ContentType)
-    object_id = models.PositiveIntegerField()
+    object_id = models.PositiveIntegerField(db_index=True)
     kind = models.IntegerField(choices=((Kind.add, 'add'),
                                         (Kind.update, 'update'),
                                         (Kind.delete, 'delete')))
@@ -67,7 +285,10 @@ class Change(models.Model):
     objects = ChangeManager()
 
     class Meta:
-        unique_together = ('content_type', 'object_id')
+        # An object may briefly have more than one entry, see ``log``.
+        # Tables created by older versions have a unique index on
+        # (content_type_id, object_id), which still works, but should be
+        # dropped (see ``ChangeManager._replace``).
         db_table = 'django_search_changes'
 
     @property
@@ -79,53 +300,216 @@ class Change(models.Model):
         return self.content_type.model_class()
 
 
+class IndexCursorManager(models.Manager):
+    def get_position(self, name):
+        """Return the id of the last change applied to the index
+        ``name``, or 0 if none has been applied yet.
+        """
+        try:
+            return self.get(index=name).position
+        except IndexCursor.DoesNotExist:
+            return 0
+
+    def set_position(self, name, position):
+        cursor, created = self.get_or_create(index=name,
+                                             defaults={'position': position})
+        if not created:
+            self.filter(index=name).update(position=position)
+
+
+class IndexCursor(models.Model):
+    """Stores, for each index, the id of the last ``Change`` that has
+    been applied to it.
+
+    Changes get increasing ids, and an object changed again is logged
+    with a new id, so this allows each index to be updated on it's own
+    schedule (see ``update.apply_changes``). The position stays behind
+    changes that were logged less than ``VISIBILITY_LAG`` seconds ago,
+    and those are looked at again by the next update.
+    """
+
+    index = models.CharField(max_length=255, unique=True)
+    position = models.PositiveIntegerField(default=0)
+
+    objects = IndexCursorManager()
+
+    class Meta:
+        db_table = 'django_search_cursors'
+
+
+# Changes logged while buffering is enabled are collected per thread,
+# and written at once when buffering ends.
+_buffer = threading.local()
+
+def is_buffering():
+    return getattr(_buffer, 'depth', 0) > 0
+
+def start_buffering(reset=False):
+    """Collect logged changes in memory, rather than writing them to
+    the database immediately.
+
+    Each object changed multiple times is only logged once. Calls may
+    be nested; the changes are kept until the outermost buffering
+    scope ends (see ``stop_buffering``). If ``reset`` is true, scopes
+    left open on this thread are abandoned, and their changes discarded.
+    """
+    if reset or not is_buffering():
+        _buffer.depth = 0
+        _buffer.changes = {}
+    _buffer.depth += 1
+
+def stop_buffering(write=True):
+    """End the current buffering scope. If it is the outermost one,
+    the collected changes are written to the log (with a constant
+    number of queries) if ``write`` is true, or discarded otherwise,
+    e.g. because the transaction they were made in was rolled back.
+    """
+    if not is_buffering():
+        return
+    _buffer.depth -= 1
+    if _buffer.depth == 0:
+        changes, _buffer.changes = _buffer.changes, {}
+        if write:
+            Change.objects.log_many(changes)
+
+def buffered_changes(func):
+    """Decorator that buffers the changes logged while ``func`` runs.
+
+    They are written once it returns, or discarded if it raises an
+    exception. Useful with ``transaction.commit_on_success``, if this
+    decorator is applied first (i.e. is listed below it)::
+
+        @transaction.commit_on_success
+        @buffered_changes
+        def import_books():
+            ...
+    """
+    def wrapper(*args, **kwargs):
+        start_buffering()
+        try:
+            result = func(*args, **kwargs)
+        except:
+            stop_buffering(write=False)
+            raise
+        stop_buffering()
+        return result
+    wrapper.__name__ = func.__name__
+    wrapper.__doc__ = func.__doc__
+    return wrapper
+
+
 # List of all models which's changes are logged. You're not supposed to
 # interact with this code yourself - it is used to keep a global registry
 # across multiple indexes. Register your models with your index.
 _LOGGED_MODELS = []
 
+# Maps each model class whose save/delete signals we listen to (the
+# logged models and all their subclasses) to what needs to be logged
+# when one of it's instances changes; see ``_log_targets``.
+_LOG_TARGETS = {}
+
 def log_model(model):
     if not model in _LOGGED_MODELS:
         _LOGGED_MODELS.append(model)
+        # the targets of already watched classes may change as well,
+        # e.g. if a parent of a registered model is registered.
+        for cls in _LOG_TARGETS.keys():
+            _LOG_TARGETS[cls] = _log_targets(cls)
+        _watch(model)
 
 
-def _what_needs_to_be_logged(instance):
-    """Checks if ``instance`` should be logged, e.g. if it's model is
-    registered.
+def _watch(cls):
+    """Start logging changes to instances of ``cls`` and it's
+    subclasses.
+
+    Signal handlers are connected for those classes only, so that
+    saving instances of models that are not indexed costs nothing.
+    """
+    if cls not in _LOG_TARGETS:
+        _LOG_TARGETS[cls] = _log_targets(cls)
+        signals.post_save.connect(_handle_save, sender=cls)
+        signals.post_delete.connect(_handle_delete, sender=cls)
+    for subclass in cls.__subclasses__():
+        _watch(subclass)
+
+
+def _handle_class_prepared(sender, **kwargs):
+    # Subclasses of a logged model may be defined after it was
+    # registered; Django also creates subclasses on the fly for
+    # querysets using ``defer()`` or ``only()``.
+    for model in _LOGGED_MODELS:
+        if issubclass(sender, model):
+            _watch(sender)
+            break
+
+
+def _parent_link_path(cls, model):
+    """Return the names of the parent link fields that lead from an
+    instance of ``cls`` to the instance of it's ancestor ``model``, or
+    ``None`` if ``model`` isn't a concrete ancestor of ``cls``.
+    """
+    if cls is model:
+        return ()
+    for parent, link in cls._meta.parents.items():
+        path = _parent_link_path(parent, model)
+        if path is not None:
+            return (link.name,) + path
+    return None
+
+
+def _log_targets(cls):
+    """Determine what to log when an instance of ``cls`` changes.
 
     This is more complicated than maybe expected due to model
     inheritance. First, if a base model class A is registered, and an
     instance of the subclass B of that model is changed, we **do**
-    want to log that change, i.e. we would use ``isinstance()``.
+    want to log that change, i.e. we would use ``issubclass()``.
 
     But, we want to log it as a change to A, not B - after all, this
     is how the user chose to register his models. In addition, in the
     strange case that both A and B are registered, we would like to
     log **two** changes, to both models.
 
-    So, this function not only has to determine **if** to log
-    ``instance``, but also what exactly to log, and then returns a
-    tuple of instances which are to be considered changed.
-
-    Usually, that tuple will only contain ``instance`` itself, or be
-    empty if no logging should be place. In scenarios like above, it
-    may contain an instance of one of the parent models instead, or
-    multiple of those.
+    So, this function not only has to determine **if** to log changes
+    to ``cls``, but also what exactly to log. It returns a tuple with
+    one entry per instance to be considered changed, each being a
+    tuple of parent link field names to follow from the changed
+    instance to get there. Usually, that tuple will only contain an
+    empty path, which stands for the instance itself.
 
-    # TODO: not tested with multiple model inheritance, and model
-    inheritance involving more than two generations.
+    Proxy models (including the classes Django creates for deferred
+    loading) share the table of their concrete model, so changes to
+    them are logged like changes to the concrete model.
     """
+    concrete = cls
+    while getattr(concrete._meta, 'proxy', False):
+        concrete = concrete._meta.proxy_for_model
 
     result = []
     for model in _LOGGED_MODELS:
-        # 1) the instance's model was registered
-        if type(instance) is model:
-            result.append(instance)
-        # 2) the instance's model is a subclass of a registered model
-        elif isinstance(instance, model):
-            # get the parent link OneToOneField
-            parent_link = instance._meta.parents[model]
-            result.append(getattr(instance, parent_link.name))
+        if issubclass(cls, model):
+            path = _parent_link_path(concrete, model)
+            # ``model`` is a proxy itself
+            if path is None:
+                path = ()
+            result.append(path)
+    return tuple(result)
+
+
+def _what_needs_to_be_logged(instance):
+    """Returns a tuple of instances which are to be considered changed
+    when ``instance`` is, as determined by ``_log_targets``.
+    """
+    try:
+        targets = _LOG_TARGETS[type(instance)]
+    except KeyError:
+        return ()
+    result = []
+    for path in targets:
+        target = instance
+        for name in path:
+            target = getattr(target, name)
+        result.append(target)
     return tuple(result)
 
 
@@ -142,5 +526,4 @@ def _handle_delete(sender, instance, **kwargs):
         Change.objects.log_delete(instance)
 
 
-signals.post_save.connect(_handle_save)
-signals.post_delete.connect(_handle_delete)
\ No newline at end of file
+signals.class_prepared.connect(_handle_class_prepared)
\ No newline at end of file
@@ -0,0 +1,251 @@
+"""Helpers to build index documents in multiple processes.
+
+Xapian only allows a single writer per database, but most of the time
+spent indexing usually goes into Python code: the ``Data`` field
+methods, following relations, encoding values. That part can be done
+by a pool of worker processes, which then hand the finished documents
+over to the one process holding the ``IndexerConnection``.
+
+Requires the ``multiprocessing`` module (Python 2.6+), and a platform
+that supports ``fork()``: The workers inherit the index classes and
+querysets from the parent process rather than having them pickled.
+"""
+
+import sys
+import time
+import itertools
+import traceback
+import Queue
+
+from django.db import connection, reset_queries
+import xappy
+
+from utils import chunked_pks
+
+try:
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+
+__all__ = ('pk_ranges', 'run_tasks', 'iter_documents',)
+
+
+# default number of finished documents that may be waiting for the
+# writer; the workers block once the queue is full.
+DEFAULT_QUEUE_SIZE = 500
+
+# number of tasks assigned to a worker at once; one in progress, one
+# waiting, so the worker doesn't need to wait for us between tasks.
+TASKS_PER_WORKER = 2
+
+
+# messages sent from the workers to the parent
+_RESULT, _DONE, _ERROR = range(3)
+
+
+def pk_ranges(queryset, chunk_size):
+    """Split the objects of ``queryset`` into ranges of (at most)
+    ``chunk_size`` objects each, returned as a list of inclusive
+    ``(first_pk, last_pk)`` tuples, in primary key order.
+
+    Only the primary keys are loaded, ``chunk_size`` at a time.
+    """
+    return [(chunk[0], chunk[-1])
+            for chunk in chunked_pks(queryset, chunk_size)]
+
+
+def _serialize(document):
+    # Xappy's document classes use __slots__, and we want to keep what
+    # goes through the pipe small anyway.
+    return document.id, [(f.name, f.value) for f in document.fields]
+
+
+def _deserialize(data):
+    id, fields = data
+    return xappy.UnprocessedDocument(id,
+        [xappy.Field(name, value) for name, value in fields])
+
+
+def _worker(number, func, tasks, results):
+    try:
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            task_id, attempt, args = task
+            for item in func(args):
+                results.put((_RESULT, (attempt, item)))
+            results.put((_DONE, (number, task_id, attempt)))
+            reset_queries()
+    except Exception:
+        results.put((_ERROR, "".join(traceback.format_exception(
+            *sys.exc_info()))))
+
+
+class _Worker(object):
+    def __init__(self, number, func, results):
+        self.number = number
+        # tasks assigned to this worker, and when
+        self.tasks = {}
+        self.queue = multiprocessing.Queue()
+        self.process = multiprocessing.Process(target=_worker,
+            args=(number, func, self.queue, results))
+        self.process.daemon = True
+        self.process.start()
+
+    def assign(self, task_id, attempt, args):
+        self.tasks[task_id] = time.time()
+        self.queue.put((task_id, attempt, args))
+
+
+def run_tasks(func, tasks, workers, queue_size=DEFAULT_QUEUE_SIZE,
+              lease_timeout=None, done=None, max_restarts=None):
+    """Call ``func`` for each item in the list ``tasks``, distributed
+    among ``workers`` processes, and yield the items of the iterables
+    it returns (which need to be picklable), in no particular order.
+
+    Each task is assigned to exactly one worker at a time. If a worker
+    dies, it's tasks are assigned to the other workers, and a new worker
+    is started in it's place (at most ``max_restarts`` times, by default
+    twice the number of workers). If a worker doesn't finish a task
+    within ``lease_timeout`` seconds, the task is assigned to another
+    worker; from then on, only the items of that latest attempt are
+    yielded, and only it can finish the task, so that an old attempt
+    can't yield outdated items after newer ones. Items yielded before
+    may be yielded again, so handling them needs to be idempotent.
+
+    ``done`` is called with each task once all of it's items have been
+    yielded.
+
+    At most ``queue_size`` items will be buffered; if the caller can't
+    keep up, the workers wait.
+    """
+    if multiprocessing is None:
+        raise RuntimeError('Processing in parallel requires the '
+            'multiprocessing module (Python 2.6 or later).')
+    if not tasks:
+        return
+    if max_restarts is None:
+        max_restarts = workers * 2
+
+    pending = range(len(tasks))   # not currently assigned
+    unfinished = set(pending)
+    # the latest attempt at each unfinished task, and the other way round
+    attempts = itertools.count()
+    latest, current = {}, {}
+    results = multiprocessing.Queue(queue_size)
+
+    # The workers must not share our database connection (the socket
+    # would be used by multiple processes at once); they will open their
+    # own, and we will reconnect on our next query.
+    connection.close()
+
+    def assign(worker):
+        for task_id in pending[:]:
+            if len(worker.tasks) >= TASKS_PER_WORKER:
+                break
+            if task_id not in unfinished:
+                pending.remove(task_id)
+            elif task_id not in worker.tasks:
+                pending.remove(task_id)
+                attempt = attempts.next()
+                current.pop(latest.get(task_id), None)
+                latest[task_id], current[attempt] = attempt, task_id
+                worker.assign(task_id, attempt, tasks[task_id])
+
+    pool = [_Worker(i, func, results) for i in range(min(workers, len(tasks)))]
+    last_check = time.time()
+    try:
+        for worker in pool:
+            assign(worker)
+
+        while unfinished:
+            try:
+                kind, data = results.get(timeout=1)
+            except Queue.Empty:
+                kind = None
+
+            if kind == _RESULT:
+                attempt, item = data
+                # drop the items of attempts that were superseded, or of
+                # tasks that are already finished
+                if attempt in current:
+                    yield item
+            elif kind == _DONE:
+                number, task_id, attempt = data
+                pool[number].tasks.pop(task_id, None)
+                if attempt in current:
+                    del current[attempt], latest[task_id]
+                    unfinished.remove(task_id)
+                    if done:
+                        done(tasks[task_id])
+            elif kind == _ERROR:
+                raise RuntimeError('A task failed in a worker process:\n%s'
+                    % data)
+
+            # look after the workers about once a second
+            now = time.time()
+            if kind == _RESULT and now - last_check < 1:
+                continue
+            last_check = now
+            for worker in pool:
+                if not worker.process.is_alive():
+                    if max_restarts <= 0:
+                        raise RuntimeError('Worker processes keep dying, '
+                            'giving up')
+                    max_restarts -= 1
+                    pending[:0] = [t for t in worker.tasks if t in unfinished]
+                    pool[worker.number] = _Worker(worker.number, func, results)
+                elif lease_timeout:
+                    for task_id, assigned in worker.tasks.items():
+                        if now - assigned > lease_timeout and \
+                                task_id in unfinished and \
+                                task_id not in pending:
+                            # keep the lease with the old worker as well,
+                            # it might still finish first
+                            worker.tasks[task_id] = now
+                            pending.insert(0, task_id)
+            for worker in pool:
+                assign(worker)
+    finally:
+        for worker in pool:
+            worker.queue.put(None)
+        for worker in pool:
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.process.join()
+
+
+def iter_documents(index, queryset, workers, chunk_size,
+                   queue_size=DEFAULT_QUEUE_SIZE, done=None, ranges=None):
+    """Build the documents for all objects in ``queryset`` using
+    ``workers`` processes, and yield them as ``UnprocessedDocument``
+    instances, ready to be written by the caller.
+
+    The queryset is split into primary key ranges of ``chunk_size``
+    objects, which are distributed among the workers. At most
+    ``queue_size`` finished documents will be buffered; if the caller
+    can't keep up writing, the workers wait.
+
+    Documents are yielded in no particular order. ``done`` is called
+    with each range once all of it's documents have been yielded. If
+    the caller needs to know the ranges, it can split the queryset
+    itself (see ``pk_ranges``) and pass them as ``ranges``.
+
+    ``index`` needs to be connected to the writable database already,
+    since the workers rely on the term prefix information it provides.
+    """
+    if index._prefix_lengths is None:
+        index._connect_indexer()
+
+    def build((first_pk, last_pk)):
+        objects = queryset.filter(pk__gte=first_pk, pk__lte=last_pk).\
+            order_by('pk')
+        for obj in objects:
+            yield _serialize(index._document_for_instance(obj))
+
+    if ranges is None:
+        ranges = pk_ranges(queryset, chunk_size)
+    for data in run_tasks(build, ranges, workers, queue_size, done=done):
+        yield _deserialize(data)
@@ -0,0 +1,163 @@
+"""Support for indexes that are split across multiple Xapian databases.
+
+An index class with ``shards = N`` stores its documents in N separate
+databases below its ``location``. The classes here hide that fact from
+the rest of the code: ``ShardedIndexerConnection`` looks like a single
+Xappy ``IndexerConnection``, routing each document to its shard, and
+``connect_searcher`` returns a ``SearchConnection`` that queries all
+shards as one combined database.
+"""
+
+import os
+
+import xapian
+import xappy
+
+
+__all__ = ('shard_location', 'shard_for', 'shard_for_content_type',
+           'filter_shard', 'ShardedIndexerConnection', 'connect_searcher',)
+
+
+def shard_location(location, shard):
+    """Return the path of database number ``shard`` of a sharded index
+    at ``location``.
+    """
+    return os.path.join(location, 'shard-%d' % shard)
+
+
+def shard_for(document_id, shards, shard_by='content_type'):
+    """Return the number of the shard the document with the id
+    ``document_id`` belongs to.
+
+    With ``shard_by='content_type'``, all documents of a model end up
+    in the same shard; with ``shard_by='hash'``, documents are spread
+    evenly across all shards, by the primary key of their object modulo
+    the number of shards, which the database can compute as well (see
+    ``filter_shard``). Both rely on the default document id format (see
+    ``IndexDataBase.document_id``), and integer primary keys.
+    """
+    object_id, content_type_id = document_id.rsplit('-', 1)
+    if shard_by == 'content_type':
+        return shard_for_content_type(int(content_type_id), shards)
+    elif shard_by == 'hash':
+        return int(object_id) % shards
+    else:
+        raise ValueError('Unsupported shard_by value: %r' % shard_by)
+
+
+def shard_for_content_type(content_type_id, shards):
+    """Return the number of the shard that documents with the given
+    content type belong to, with ``shard_by='content_type'``.
+    """
+    return content_type_id % shards
+
+
+def filter_shard(queryset, shards, shard):
+    """Restrict ``queryset`` to the objects whose documents belong to
+    ``shard``, with ``shard_by='hash'``, so that building a shard does
+    not need to load the objects of all others.
+    """
+    from django.db import connection
+    qn = connection.ops.quote_name
+    meta = queryset.model._meta
+    return queryset.extra(
+        where=['%s.%s %%%% %%s = %%s' % (qn(meta.db_table),
+                                         qn(meta.pk.column))],
+        params=[shards, shard])
+
+
+class ShardedIndexerConnection(object):
+    """Wraps one Xappy ``IndexerConnection`` per shard, exposing the
+    subset of the ``IndexerConnection`` API that django-xappy uses.
+
+    Documents are written to, and deleted from, the shard their id
+    belongs to. Field actions are added to all shards in the same
+    order, so the field mappings (term prefixes, value slots) are
+    identical across all of them.
+
+    If ``only`` is given, only the shards with those numbers are
+    opened. This allows separate processes to write to different
+    shards at the same time. Attempting to write a document belonging
+    to a shard that is not open raises an ``IndexerError``.
+    """
+
+    def __init__(self, location, shards, shard_by='content_type', only=None):
+        self._shards = shards
+        self._shard_by = shard_by
+        self._connections = {}
+        if not os.path.exists(location):
+            os.makedirs(location)
+        if only is None:
+            only = range(shards)
+        for shard in only:
+            self._connections[shard] = \
+                xappy.IndexerConnection(shard_location(location, shard))
+
+    def _connection_for(self, id):
+        shard = shard_for(id, self._shards, self._shard_by)
+        try:
+            return self._connections[shard]
+        except KeyError:
+            raise xappy.IndexerError('Document "%s" belongs to shard %d, '
+                'which is not open' % (id, shard))
+
+    def _any(self):
+        return self._connections[min(self._connections)]
+
+    @property
+    def _field_mappings(self):
+        return self._any()._field_mappings
+
+    def get_fields_with_actions(self):
+        return self._any().get_fields_with_actions()
+
+    def add_field_action(self, fieldname, fieldtype, **kwargs):
+        for shard in sorted(self._connections):
+            self._connections[shard].add_field_action(
+                fieldname, fieldtype, **kwargs)
+
+    def replace(self, document):
+        return self._connection_for(document.id).replace(document)
+
+    def delete(self, id):
+        self._connection_for(id).delete(id)
+
+    def iterids(self):
+        for shard in sorted(self._connections):
+            for id in self._connections[shard].iterids():
+                yield id
+
+    def get_doccount(self):
+        return sum([c.get_doccount() for c in self._connections.values()])
+
+    def set_metadata(self, key, value):
+        for connection in self._connections.values():
+            connection.set_metadata(key, value)
+
+    def get_metadata(self, key):
+        return self._any().get_metadata(key)
+
+    def flush(self):
+        for connection in self._connections.values():
+            connection.flush()
+
+    def close(self):
+        for connection in self._connections.values():
+            connection.close()
+        self._connections = {}
+
+
+def connect_searcher(location, shards):
+    """Open a Xappy ``SearchConnection`` that searches all shards of
+    the index at ``location`` as if they were a single database.
+
+    Xappy itself only opens a single database, so we add the others to
+    the underlying Xapian database object. The configuration (field
+    actions and mappings) is read from the first shard, which is fine
+    since it is the same for all of them.
+    """
+    connection = xappy.SearchConnection(shard_location(location, 0))
+    for shard in range(1, shards):
+        connection._index.add_database(
+            xapian.Database(shard_location(location, shard)))
+    return connection
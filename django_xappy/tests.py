@@ -0,0 +1,90 @@
+import datetime
+import tempfile
+import shutil
+
+from django.test import TestCase
+from django.contrib.contenttypes.models import ContentType
+
+from models import Change, IndexCursor, VISIBILITY_LAG
+import update
+
+
+class FakeIndex(object):
+    """Stands in for an index, so that the ``ChangeApplier`` can be
+    tested without Xapian.
+    """
+    location = None
+    flush_every = flush_interval = None
+    skipped = 0
+    _unflushed = 0
+
+    def _connect_indexer(self):
+        pass
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class ChangeApplierTest(TestCase):
+
+    def setUp(self):
+        FakeIndex.location = tempfile.mkdtemp()
+        self.content_type = ContentType.objects.get_for_model(ContentType)
+        # record which changes are applied, rather than building documents
+        self.applied = []
+        self._changed_documents = update._changed_documents
+        def changed_documents(indexes, changes, positions):
+            self.applied.extend([change.pk for change in changes])
+            return []
+        update._changed_documents = changed_documents
+
+    def tearDown(self):
+        update._changed_documents = self._changed_documents
+        shutil.rmtree(FakeIndex.location)
+
+    def log(self, id, age=0):
+        Change.objects.create(id=id, content_type=self.content_type,
+            object_id=id, kind=Change.Kind.update,
+            timestamp=datetime.datetime.now() - \
+                datetime.timedelta(seconds=age))
+
+    def position(self):
+        return IndexCursor.objects.get_position(
+            update.cursor_name(FakeIndex()))
+
+    def test_late_change_is_applied(self):
+        applier = update.ChangeApplier([FakeIndex])
+        self.log(5)
+        applier.apply_chunk()
+        self.assertEqual(self.applied, [5])
+
+        # a transaction that got a lower id commits only now
+        self.log(3)
+        applier.apply_chunk()
+        self.assertEqual(self.applied, [5, 3])
+
+        # nothing is applied twice
+        applier.apply_chunk()
+        self.assertEqual(self.applied, [5, 3])
+        applier.close()
+
+    def test_position_stays_behind_recent_changes(self):
+        self.log(1, age=VISIBILITY_LAG * 2)
+        self.log(2)
+        applier = update.ChangeApplier([FakeIndex])
+        applier.apply_chunk()
+        applier.close()
+        self.assertEqual(self.applied, [1, 2])
+        self.assertEqual(self.position(), 1)
+
+        # the next update applies the recent change again, since a lower
+        # id might still have been committed after it
+        self.log(3, age=VISIBILITY_LAG * 2)
+        self.applied = []
+        applier = update.ChangeApplier([FakeIndex])
+        applier.apply_chunk()
+        applier.close()
+        self.assertEqual(self.applied, [2, 3])
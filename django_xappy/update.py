@@ -1,11 +1,19 @@
 import os, sys
-import datetime, time
+import time
 import logging
 
 from django.conf import settings
-from models import Change
+from django.db import connection, reset_queries
+from django.contrib.contenttypes.models import ContentType
+from models import Change, IndexCursor
 
-from index import get_indexes
+import xapian
+
+from index import get_indexes, document_hash, HASH_KEY
+from cache import REVISION_KEY
+from utils import chunked_queryset, chunked_pks
+import parallel
+import shards as sharding
 
 
 # setup output
@@ -15,8 +23,494 @@ log.addHandler(console)
 log.setLevel(logging.INFO)
 
 
-# TODO: use transaction for delete?
-def rebuild(indexes=None, clear_changes=False):
+# number of objects fetched from the database at once during a rebuild,
+# and the number of changes the daemon applies at once.
+DEFAULT_CHUNK_SIZE = 1000
+DAEMON_CHUNK_SIZE = 100
+
+# seconds after which a chunk of changes that a worker process did not
+# finish applying is given to another worker
+DEFAULT_LEASE_TIMEOUT = 600
+
+
+# name of the file in a temporary index directory that records the
+# progress of a rebuild, and how often it is updated (in seconds).
+CHECKPOINT_FILE = 'rebuild-checkpoint.json'
+CHECKPOINT_INTERVAL = 60
+
+# The live index at ``Index.location`` is a symbolic link to the current
+# generation, a directory next to it; a rebuild creates a new generation
+# and then switches the link. Replaced generations are marked with
+# RETIRED_FILE, and removed GENERATION_GRACE seconds later, which gives
+# searchers that still use them time to move on.
+RETIRED_FILE = 'retired'
+GENERATION_GRACE = 600
+
+# the index metadata key storing the change log position a generation
+# was built up to.
+POSITION_KEY = 'django_xappy.position'
+
+
+def model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+class _Checkpoints(object):
+    """Records the progress of a rebuild in a file in the directory of
+    each new index, so that the rebuild can be resumed if interrupted.
+
+    For each model, the last primary key processed (objects are
+    processed in primary key order) and the number of documents written
+    are stored. Checkpoints are written at most every ``interval``
+    seconds, and only after the indexes have been flushed, so they
+    never claim more than is actually on disk.
+    """
+
+    def __init__(self, interval=CHECKPOINT_INTERVAL):
+        self.interval = interval
+        self.states = {}
+        self.last_save = time.time()
+
+    def _path(self, index):
+        return os.path.join(index.location, CHECKPOINT_FILE)
+
+    def start(self, index, position):
+        self.states[index] = {'position': position, 'models': {}}
+
+    def load(self, index):
+        """Load the checkpoint of ``index``, and return the change log
+        position recorded when the rebuild was started.
+        """
+        from django.utils import simplejson
+        f = open(self._path(index))
+        try:
+            self.states[index] = simplejson.load(f)
+        finally:
+            f.close()
+        return self.states[index]['position']
+
+    def get(self, index, model):
+        return self.states[index]['models'].setdefault(model_label(model),
+            {'last_pk': None, 'documents': 0, 'done': False})
+
+    def wrote(self, index, model, documents=1):
+        self.get(index, model)['documents'] += documents
+
+    def reached(self, index, model, pk):
+        self.get(index, model)['last_pk'] = pk
+
+    def finished(self, index, model):
+        self.get(index, model)['done'] = True
+        self.save()
+
+    def tick(self):
+        if time.time() - self.last_save >= self.interval:
+            self.save()
+
+    def save(self):
+        from django.utils import simplejson
+        for index in self.states:
+            index.flush()
+        for index, state in self.states.items():
+            # write to a temporary file first, so that we never leave
+            # a partially written checkpoint behind.
+            path = self._path(index)
+            f = open(path + '.tmp', 'w')
+            try:
+                simplejson.dump(state, f)
+            finally:
+                f.close()
+            os.rename(path + '.tmp', path)
+        self.last_save = time.time()
+
+    def remove(self, index):
+        if index in self.states:
+            del self.states[index]
+            if os.path.exists(self._path(index)):
+                os.remove(self._path(index))
+
+
+def _in_order(ranges, reached):
+    """Return a callback for ``parallel.run_tasks`` that calls
+    ``reached`` with the last primary key of the given ranges, in order,
+    once all previous ranges are done as well.
+    """
+    ranges = list(ranges)
+    finished = set()
+    def done(task):
+        finished.add(task)
+        while ranges and ranges[0] in finished:
+            reached(ranges.pop(0)[1])
+    return done
+
+
+def _fill_index(index, chunk_size, workers=None, shard=None):
+    """Add all objects of all models registered with ``index``.
+
+    If ``shard`` is given, only the documents belonging to that shard
+    are added.
+    """
+    for model, queryset in index.get_models(True):
+        if shard is not None:
+            if index.shard_for_model(model) not in (None, shard):
+                continue
+            if index.shard_by == 'hash':
+                queryset = sharding.filter_shard(queryset, index.shards,
+                                                 shard)
+        _fill_model(index, model, queryset, chunk_size, workers)
+
+
+def _fill_model(index, model, queryset, chunk_size, workers=None,
+                checkpoints=None):
+    if checkpoints:
+        state = checkpoints.get(index, model)
+        if state['done']:
+            log.info('Objects of type "%s" are already indexed.' % \
+                model.__name__)
+            return
+        if state['last_pk'] is not None:
+            log.info('Resuming after #%s of type "%s"...' % \
+                (state['last_pk'], model.__name__))
+            queryset = queryset.filter(pk__gt=state['last_pk'])
+
+    log.info('Indexing %d objects of type "%s"...' % \
+        (queryset.count(), model.__name__))
+    if workers > 1:
+        # the checkpoints need to use the same ranges as the workers
+        ranges = parallel.pk_ranges(queryset, chunk_size)
+        done = None
+        if checkpoints:
+            def reached(pk):
+                checkpoints.reached(index, model, pk)
+                checkpoints.tick()
+            index._connect_indexer()
+            done = _in_order(ranges, reached)
+        for document in parallel.iter_documents(index, queryset, workers,
+                chunk_size, done=done, ranges=ranges):
+            index.replace_document(document)
+            if checkpoints:
+                checkpoints.wrote(index, model)
+    else:
+        for i, obj in enumerate(chunked_queryset(queryset, chunk_size)):
+            # with DEBUG enabled, Django would otherwise keep a
+            # record of every single query we run.
+            if i % chunk_size == 0:
+                reset_queries()
+                if checkpoints:
+                    checkpoints.tick()
+            log.debug('\t#%d: %s' % (obj.pk, str(obj)))
+            index.add(obj)
+            if checkpoints:
+                checkpoints.wrote(index, model)
+                checkpoints.reached(index, model, obj.pk)
+
+    if checkpoints:
+        checkpoints.finished(index, model)
+
+
+def _fill_indexes(indexes, chunk_size, workers=None, checkpoints=None):
+    """Add all objects of all models registered with any of ``indexes``
+    to the respective indexes.
+
+    The objects of a model registered with multiple indexes are only
+    loaded once, and the documents for all of those indexes are built
+    in the same pass.
+    """
+    models = []
+    for index in indexes:
+        for model in index.get_models():
+            if not model in models:
+                models.append(model)
+
+    for model in models:
+        sharing = [index for index in indexes if model in index.get_models()]
+        if len(sharing) == 1:
+            _fill_model(sharing[0], model, sharing[0].get_queryset(model),
+                        chunk_size, workers, checkpoints=checkpoints)
+        else:
+            _fill_shared(sharing, model, chunk_size, workers, checkpoints)
+
+
+def _fill_shared(indexes, model, chunk_size, workers=None, checkpoints=None):
+    """Add all objects of ``model`` to all ``indexes``, which all
+    register it, reading the objects only once.
+    """
+    queryset = _model_queryset(indexes, model)
+
+    # the primary key after which to continue, for each index
+    after = [None] * len(indexes)
+    if checkpoints:
+        states = [checkpoints.get(index, model) for index in indexes]
+        indexes = [index for index, state in zip(indexes, states)
+                   if not state['done']]
+        if not indexes:
+            log.info('Objects of type "%s" are already indexed.' % \
+                model.__name__)
+            return
+        after = [state['last_pk'] for state in states if not state['done']]
+        if not None in after:
+            log.info('Resuming after #%s of type "%s"...' % \
+                (min(after), model.__name__))
+            queryset = queryset.filter(pk__gt=min(after))
+
+    log.info('Indexing %d objects of type "%s" for %d indexes...' % \
+        (queryset.count(), model.__name__, len(indexes)))
+    for index in indexes:
+        # documents are built using the term prefix information
+        index._connect_indexer()
+
+    def documents(objects):
+        # yields ``(index number, document)`` tuples
+        pks = [obj.pk for obj in objects]
+        for i, index in enumerate(indexes):
+            # the queryset restriction the model was registered with
+            restriction = index._models[model]
+            if restriction is not None:
+                included = set(restriction.filter(pk__in=pks).\
+                    values_list('pk', flat=True))
+            for obj in objects:
+                if after[i] is not None and obj.pk <= after[i]:
+                    continue
+                if restriction is None or obj.pk in included:
+                    yield i, index._document_for_instance(obj)
+
+    def write(i, document):
+        indexes[i].replace_document(document)
+        if checkpoints:
+            checkpoints.wrote(indexes[i], model)
+
+    def reached(pk):
+        if checkpoints:
+            for index in indexes:
+                checkpoints.reached(index, model, pk)
+            checkpoints.tick()
+
+    if workers > 1:
+        def build((first_pk, last_pk)):
+            objects = queryset.filter(pk__gte=first_pk, pk__lte=last_pk).\
+                order_by('pk')
+            for i, document in documents(list(objects)):
+                yield i, parallel._serialize(document)
+
+        ranges = parallel.pk_ranges(queryset, chunk_size)
+        for i, data in parallel.run_tasks(build, ranges, workers,
+                                          done=_in_order(ranges, reached)):
+            write(i, parallel._deserialize(data))
+    else:
+        def write_chunk(objects):
+            for i, document in documents(objects):
+                write(i, document)
+            if objects:
+                reached(objects[-1].pk)
+            # with DEBUG enabled, Django would otherwise keep a record of
+            # every single query we run.
+            reset_queries()
+
+        objects = []
+        for obj in chunked_queryset(queryset, chunk_size):
+            objects.append(obj)
+            if len(objects) == chunk_size:
+                write_chunk(objects)
+                objects = []
+        write_chunk(objects)
+
+    if checkpoints:
+        for index in indexes:
+            checkpoints.finished(index, model)
+
+
+def _set_flush_policy(index, flush_every=None, flush_interval=None):
+    """Override the flush policy defined by the index class, if values
+    are given.
+    """
+    if flush_every is not None:
+        index.flush_every = flush_every
+    if flush_interval is not None:
+        index.flush_interval = flush_interval
+
+
+def _fill_shard(index_klass, location, shard, chunk_size, flush_policy):
+    index = index_klass(location, open_shards=(shard,))
+    _set_flush_policy(index, *flush_policy)
+    try:
+        # make sure the shard database exists, even if empty
+        index._connect_indexer()
+        _fill_index(index, chunk_size, shard=shard)
+    finally:
+        index.close()
+
+
+def _fill_shards(index, chunk_size, flush_policy=(None, None)):
+    """Build all shards of the sharded ``index`` at the same time, each
+    in a separate process.
+    """
+    if parallel.multiprocessing is None:
+        raise RuntimeError('Rebuilding a sharded index requires the '
+            'multiprocessing module (Python 2.6 or later).')
+
+    # don't share the database connection with the child processes
+    connection.close()
+
+    processes = []
+    for shard in range(index.shards):
+        process = parallel.multiprocessing.Process(target=_fill_shard,
+            args=(type(index), index.location, shard, chunk_size,
+                  flush_policy))
+        process.start()
+        processes.append(process)
+    for process in processes:
+        process.join()
+
+    failed = [str(shard) for shard, process in enumerate(processes)
+              if process.exitcode != 0]
+    if failed:
+        raise RuntimeError('Failed to build shard(s) %s' % ", ".join(failed))
+
+
+def cursor_name(index):
+    """Return the name under which the change cursor of ``index`` (an
+    index class or instance) is stored.
+    """
+    if not isinstance(index, type):
+        index = type(index)
+    return '%s.%s' % (index.__module__, index.__name__)
+
+
+def find_indexes(names):
+    """Return the registered index classes with the given names; each
+    may either be the class name or the full dotted path.
+    """
+    result = []
+    for name in names:
+        matches = [klass for klass in get_indexes()
+                   if name in (klass.__name__, cursor_name(klass))]
+        if not matches:
+            raise ValueError('Unknown index: %s' % name)
+        elif len(matches) > 1:
+            raise ValueError('Ambiguous index name: %s' % name)
+        result.append(matches[0])
+    return result
+
+
+def find_models(names):
+    """Return the models with the given names, each in the form
+    ``app_label.ModelName``.
+    """
+    from django.db.models import get_model
+    result = []
+    for name in names:
+        try:
+            app_label, model_name = name.split('.')
+        except ValueError:
+            raise ValueError('Model names need to be given as '
+                '"app_label.ModelName": %s' % name)
+        model = get_model(app_label, model_name)
+        if model is None:
+            raise ValueError('Unknown model: %s' % name)
+        result.append(model)
+    return result
+
+
+def collect_garbage():
+    """Remove changes from the log that have been applied to all
+    registered indexes.
+    """
+    positions = [IndexCursor.objects.get_position(cursor_name(klass))
+                 for klass in get_indexes()]
+    if positions and min(positions):
+        log.debug('Removing changes up to #%d from the changelog.' % \
+            min(positions))
+        Change.objects.remove_applied(min(positions))
+
+
+def _switch_generation(location, generation):
+    """Make the index in the directory ``generation`` the live one at
+    ``location``.
+
+    The symbolic link at ``location`` is replaced atomically, so there
+    is an index at ``location`` at any time. The previous generation is
+    marked as retired (see ``collect_generations``).
+
+    The one exception is the first switch of an index created before
+    generations were used, where ``location`` is still a directory: a
+    directory can't be replaced by a link in one step, so it is moved
+    aside right before the link is moved into place, and opening the
+    index may fail in between.
+    """
+    if not hasattr(os, 'symlink'):
+        # no symbolic links on this platform; replace the directory.
+        import shutil
+        if os.path.exists(location):
+            shutil.rmtree(location)
+        shutil.move(generation, location)
+        return
+
+    link = location + '.link'
+    if os.path.islink(link):
+        os.remove(link)
+    # relative, so the whole directory can be moved
+    os.symlink(os.path.basename(generation), link)
+
+    previous = None
+    if os.path.islink(location):
+        previous = os.path.realpath(location)
+    elif os.path.exists(location):
+        # an index created before generations were used; it is retired
+        # like any other generation.
+        previous = location + '-previous'
+        os.rename(location, previous)
+    os.rename(link, location)
+
+    if previous and previous != os.path.realpath(generation):
+        open(os.path.join(previous, RETIRED_FILE), 'w').close()
+
+
+def collect_generations(indexes=None, grace=GENERATION_GRACE):
+    """Remove the generations of the given indexes (or all registered
+    indexes) that were replaced by a rebuild at least ``grace`` seconds
+    ago.
+
+    Searchers notice that an index was replaced the next time they are
+    used (see ``connections.SearchConnectionPool``), so ``grace`` should
+    be longer than the time your processes may go without searching.
+    """
+    import glob, shutil
+    if not indexes:
+        indexes = get_indexes()
+    for index in indexes:
+        current = os.path.realpath(index.location)
+        for location in glob.glob(index.location + '-*'):
+            retired = os.path.join(location, RETIRED_FILE)
+            if os.path.realpath(location) == current or \
+                    not os.path.exists(retired):
+                continue
+            if time.time() - os.stat(retired).st_mtime >= grace:
+                log.info('Removing old generation "%s"...' % \
+                    os.path.basename(location))
+                shutil.rmtree(location)
+
+
+def _find_resumable(index_klass):
+    """Return the location of the most recent unfinished rebuild of
+    ``index_klass`` that can be resumed, or ``None``.
+
+    Finished generations never have a checkpoint, so are not considered.
+    """
+    import glob
+    candidates = []
+    for location in glob.glob(index_klass.location + '-*'):
+        suffix = location[len(index_klass.location)+1:]
+        if suffix.isdigit() and \
+                os.path.exists(os.path.join(location, CHECKPOINT_FILE)):
+            candidates.append((int(suffix), location))
+    if candidates:
+        return max(candidates)[1]
+    return None
+
+
+def rebuild(indexes=None, clear_changes=False, chunk_size=DEFAULT_CHUNK_SIZE,
+            workers=None, flush_every=None, flush_interval=None,
+            resume=False, models=None):
     """Fully rebuild indixes from scratch, based on current database.
 
     You should only need to run this if you make changes to the index
@@ -28,139 +522,867 @@ def rebuild(indexes=None, clear_changes=False):
     the list of all registered indexes will be used. Note that the
     latter requires your index classes to already be loaded by Python.
 
-    If you set ``clear_changes`` to True, the changelog will be cleared
-    after the rebuild. Only do this if you are rebuilding all indexes,
-    or changes affecting the other indexes may be lost.
-    """
+    Changes logged before the rebuild started are considered applied to
+    the rebuilt indexes. If you set ``clear_changes`` to True, changes
+    that are no longer needed by any index are removed from the
+    changelog afterwards (see ``collect_garbage``).
+
+    The objects of each model are loaded ``chunk_size`` rows at a time,
+    in primary key order, so that memory usage does not depend on the
+    size of your tables. If multiple of the indexes register the same
+    model, it's objects are only loaded once, and the documents for all
+    of those indexes are built in the same pass.
+
+    If ``workers`` is given, the documents are built by that many
+    processes in parallel, each handling ranges of ``chunk_size``
+    objects, while this process does the actual writing (Xapian allows
+    only a single writer). See ``django_xappy.parallel``.
 
-    import shutil
+    Sharded indexes are always built with one process per shard, each
+    writing to it's own database; ``workers`` is ignored for them.
+
+    ``flush_every`` and ``flush_interval`` override the flush policy of
+    the indexes (see ``Index.flush_every``).
+
+    The progress of the rebuild is saved regularly in the directory of
+    the new index (see ``CHECKPOINT_FILE``). If the rebuild is
+    interrupted, pass ``resume=True`` to continue where it stopped,
+    rather than starting over. This is not supported for sharded
+    indexes, which are always rebuilt from scratch.
+
+    Each rebuild creates a new generation of the index in a directory
+    next to ``Index.location``, which is a symbolic link that is then
+    switched to the new generation atomically: searches never find the
+    index missing, and pooled search connections move to the new
+    generation the next time they are used. The previous generation is
+    removed once it has been retired for ``GENERATION_GRACE`` seconds
+    (see ``collect_generations``). A daemon applying changes (see
+    ``run_daemon``) reopens the indexes as well, and continues from the
+    position the rebuild was made at.
+
+    If you pass a list of ``models``, only the documents of those models
+    are rebuilt, in place: they are deleted from the live indexes that
+    register the models, and added again. The documents of all other
+    models are left alone.
+    """
 
     if not indexes:
         indexes = get_indexes()
     elif not isinstance(indexes, (list, tuple)):
         indexes = (indexes,)
 
-    # remember the current time so that we can remove all changes
-    # up to this point if we are successful
-    indexing_started_at = datetime.datetime.now()
+    if models:
+        _rebuild_models(indexes, models, chunk_size, workers,
+                        (flush_every, flush_interval))
+        if clear_changes:
+            collect_garbage()
+        return
 
-    for index_klass in indexes:
-        # as this may take a while, we create the index in a temporary
-        # location, and then switch it with the currently active one,
-        # finally deleting the latter
-        temp_index = index_klass(index_klass.location+"-%s" % int(time.time()))
+    # Remember the most recent change so far that is surely visible
+    # (see ``Change.objects.settled_id``), and consider all changes up
+    # to it applied if we are successful. Changes that happen in the
+    # meantime possibly did not make it into the new indexes.
+    position = Change.objects.settled_id()
 
-        # index everything
-        try:
+    # as this may take a while, we create the indexes as a new
+    # generation, and then switch the live indexes over to it.
+    temp_indexes = []
+    positions = {}
+    checkpoints = _Checkpoints()
+    for index_klass in indexes:
+        location = None
+        if resume and not index_klass.shards:
+            location = _find_resumable(index_klass)
+        if location:
+            temp_index = index_klass(location)
+            positions[temp_index] = checkpoints.load(temp_index)
+            log.info('Resuming the rebuild in "%s"...' % \
+                os.path.basename(temp_index.location))
+        else:
+            temp_index = index_klass(
+                index_klass.location+"-%s" % int(time.time()))
+            positions[temp_index] = position
             log.info('Creating a new index in "%s"...' % \
                 os.path.basename(temp_index.location))
-            for model, queryset in temp_index.get_models(True):
-                log.info('Indexing %d objects of type "%s"...' % \
-                    (queryset.count(), model.__name__))
-                for obj in queryset.all():
-                    log.debug('\t#%d: %s' % (obj.pk, str(obj)))
-                    temp_index.add(obj)
-        finally:
+            if not temp_index.shards:
+                temp_index._connect_indexer()
+                checkpoints.start(temp_index, position)
+        _set_flush_policy(temp_index, flush_every, flush_interval)
+        temp_indexes.append(temp_index)
+
+    # index everything; indexes that aren't sharded are filled together,
+    # so that models registered with more than one are only read once.
+    try:
+        for temp_index in temp_indexes:
+            if temp_index.shards:
+                _fill_shards(temp_index, chunk_size,
+                             (flush_every, flush_interval))
+        _fill_indexes([temp_index for temp_index in temp_indexes
+                       if not temp_index.shards], chunk_size, workers,
+                      checkpoints)
+    finally:
+        for temp_index in temp_indexes:
             temp_index.flush()
+        # also flushes the indexes
+        checkpoints.save()
 
-        # switch the live index with the temporary one we just created
+    for index_klass, temp_index in zip(indexes, temp_indexes):
+        # switch the live index to the generation we just created
+        checkpoints.remove(temp_index)
+        temp_index._connect_indexer()
+        temp_index._indexer.set_metadata(POSITION_KEY,
+                                         str(positions[temp_index]))
+        # Shards are written by other processes, so the new generation
+        # may not have a revision yet; cached results of the previous
+        # one must not be used for it (see ``Index.result_cache``).
+        temp_index._indexer.set_metadata(REVISION_KEY, repr(time.time()))
         temp_index.close()
         log.info('Switching "%s" to live index...' % os.path.basename(temp_index.location))
         try:
-            if os.path.exists(index_klass.location):
-                shutil.rmtree(index_klass.location)
-            shutil.move(temp_index.location, index_klass.location)
+            _switch_generation(index_klass.location, temp_index.location)
         except Exception, e:
             log.error("Failed to replace live index, error was: %s"%e)
         else:
+            IndexCursor.objects.set_position(cursor_name(index_klass),
+                                             positions[temp_index])
             log.info('Done.')
 
-    # Since this was a complete reindex, we can assume that existing
-    # changelog entries are obsolete. Note however that we:
-    #   - only delete after the reindex was successful
-    #   - only delete items up to the point we started the indexing.
-    #     changes that happend in the meantime did possibly not make
-    #     it into the new index
+    collect_generations(indexes)
     if clear_changes:
-        old_changes = Change.objects.before(indexing_started_at)
-        if old_changes:
-            log.info('Deleting %d now obsolete item(s) from changelog.'
-                % old_changes.count())
-            old_changes.delete()
+        collect_garbage()
 
 
-def apply_changes():
-    """Apply logged model changes to search indexes.
+def _rebuild_models(indexes, models, chunk_size, workers=None,
+                    flush_policy=(None, None)):
+    """Replace the documents of ``models`` in the live ``indexes``.
+    """
+    for model in models:
+        if not [klass for klass in indexes if model in klass.get_models()]:
+            log.warning('"%s" is not registered with any of the indexes.' % \
+                model.__name__)
+
+    for index_klass in indexes:
+        index = index_klass()
+        _set_flush_policy(index, *flush_policy)
+        try:
+            for model in models:
+                if not model in index.get_models():
+                    continue
+                log.info('Deleting the documents of type "%s" from %s...' % \
+                    (model.__name__, index_klass.__name__))
+                log.info('Deleted %d documents.' % index.delete_all(model))
+                _fill_model(index, model, index.get_queryset(model),
+                            chunk_size, workers)
+        finally:
+            index.flush()
+            index.close()
+    log.info('Done.')
+
 
-    While ``rebuild`` may be run on a specific set of indexes, due to the
-    way changes are stored, this always needs to handle all your indexes.
-    There'd be no way to determine which changes have already been applied
-    to which index.
+def _model_queryset(indexes, model):
+    """Return a queryset of all objects of ``model``, with the loading
+    hints of all ``indexes`` registering ``model`` merged (see
+    ``Index.get_queryset``).
+
+    Applying the hints of each index in turn doesn't work, since a later
+    ``only()`` or ``defer()`` replaces an earlier one. Instead, related
+    objects are loaded if any of the indexes needs them, while columns
+    are only left out if all indexes agree: ``only`` is used if all of
+    them use it, with all their fields, ``defer`` if all of them use
+    it, with the fields they all defer.
+    """
+    queryset = model._default_manager.all()
+    registering = [index for index in indexes if model in index.get_models()]
+    if len(registering) == 1:
+        return registering[0]._apply_load_hints(queryset)
+
+    def hints(name):
+        return [tuple(getattr(index.Data, name).get(model) or ())
+                for index in registering]
+
+    for name in ('select_related', 'prefetch_related'):
+        lookups = []
+        for args in hints(name):
+            lookups.extend([arg for arg in args if not arg in lookups])
+        if lookups:
+            queryset = getattr(queryset, name)(*lookups)
+
+    only, defer = hints('only'), hints('defer')
+    if registering and all(only) and not any(defer):
+        fields = []
+        for args in only:
+            fields.extend([arg for arg in args if not arg in fields])
+        queryset = queryset.only(*fields)
+    elif registering and all(defer) and not any(only):
+        fields = [field for field in defer[0]
+                  if not [args for args in defer if not field in args]]
+        if fields:
+            queryset = queryset.defer(*fields)
+    return queryset
+
+
+def _load_objects(indexes, model, ids):
+    """Load the objects of ``model`` with the given ids, with a single
+    query, returned as a dict (id -> object).
+    """
+    return _model_queryset(indexes, model).in_bulk(ids)
+
+
+def _changed_documents(indexes, changes, positions):
+    """Determine what needs to be done to apply a list of changes to all
+    ``indexes`` they are relevant to.
+
+    The changes are grouped by content type, and the objects of each
+    content type that need to be (re-)indexed are loaded at once. Each
+    document is then built once for every index that needs it.
+
+    ``positions`` maps each index to the id of the last change already
+    applied to it; older changes are skipped.
+
+    Yields ``(index, content_type, object_id, document)`` tuples, where
+    ``document`` is ``None`` if the object needs to be deleted from
+    ``index``.
+    """
+    by_type = {}
+    for change in changes:
+        assert change.kind in (Change.Kind.add, Change.Kind.update,
+                               Change.Kind.delete), "unknown change kind"
+        by_type.setdefault(change.content_type_id, []).append(change)
+
+    for content_type_id, type_changes in by_type.items():
+        content_type = type_changes[0].content_type
+        model = content_type.model_class()
+        if model is None:
+            # The model no longer exists, so no index can be responsible
+            # for these changes; skipping them lets the positions move on.
+            log.warning('\tSkipping %d changes of type "%s" - the model '
+                'does no longer exist.', len(type_changes), content_type)
+            continue
+
+        ids = [c.object_id for c in type_changes if c.kind != Change.Kind.delete]
+        objects = ids and _load_objects(indexes, model, ids) or {}
+        missing = set()
+
+        for index in indexes:
+            update, delete = index.responsible_changes(
+                [c for c in type_changes if c.pk > positions[index]])
+            for change in delete:
+                # note it is possible that the object doesn't even
+                # exist, if it was deleted after being created, before
+                # we even did the first update.
+                yield index, content_type, change.object_id, None
+            for change in update:
+                obj = objects.get(change.object_id)
+                if obj is None:
+                    missing.add(change.object_id)
+                    continue
+                yield index, content_type, change.object_id, \
+                    index._document_for_instance(obj)
+            log.debug('\t%d objects of type "%s" were updated in, and %d '
+                'deleted from %s' % (len(update), content_type, len(delete),
+                    type(index).__name__))
+
+        for object_id in missing:
+            # Handle db objects gracefully. The reason this should
+            # not happen is that a "delete" action should normally be
+            # logged as well and is handled separately.
+            log.warning('\tSkipping %s #%d - the database record '
+                'associated with this change does no longer exist. This '
+                'should normally not happen.', content_type, object_id)
+
+
+class ChangeApplier(object):
+    """Keeps a set of indexes open, and applies logged changes to them.
+
+    The base of both ``apply_changes`` and ``run_daemon``.
     """
 
-    # connect to every index
-    indexes = []
-    for index_klass in get_indexes():
-        indexes.append(index_klass())
+    def __init__(self, indexes=None, flush_every=None, flush_interval=None,
+                 chunk_size=DEFAULT_CHUNK_SIZE):
+        if not indexes:
+            indexes = get_indexes()
+        elif not isinstance(indexes, (list, tuple)):
+            indexes = (indexes,)
+        self.chunk_size = chunk_size
+
+        # connect to the indexes, and find out where each of them is at
+        self.indexes = [index_klass() for index_klass in indexes]
+        self.positions = {}
+        self._generations = {}
+        for index in self.indexes:
+            _set_flush_policy(index, flush_every, flush_interval)
+            # documents are built using the term prefix information
+            index._connect_indexer()
+            self.positions[index] = \
+                IndexCursor.objects.get_position(cursor_name(index))
+            self._generations[index] = os.path.realpath(index.location)
+        self._saved = self.positions.copy()
+        # The positions stay behind recently logged changes (see
+        # ``advance``); these are the changes beyond them that we have
+        # already applied, and the highest id among them. All ids up to
+        # ``_floor`` are known to be applied, with no gaps in between
+        # that a change committed late could fill.
+        self._applied = set()
+        self._floor = self._high = min(self.positions.values() or [0])
+
+    def reopen_replaced(self):
+        """Reopen the indexes that a rebuild switched to a new generation
+        since we opened them.
+
+        Changes are applied to the new generation starting at the
+        position the rebuild was made at; whatever we wrote to the old
+        one since is lost with it.
+        """
+        for i, index in enumerate(self.indexes):
+            generation = os.path.realpath(index.location)
+            if generation == self._generations[index]:
+                continue
+            log.info('%s was rebuilt, reopening it...' % cursor_name(index))
+            index.close()
+            new = type(index)()
+            _set_flush_policy(new, index.flush_every, index.flush_interval)
+            new._connect_indexer()
+            position = new._indexer.get_metadata(POSITION_KEY)
+            if position:
+                position = int(position)
+            else:
+                position = IndexCursor.objects.get_position(cursor_name(new))
+            for mapping in (self.positions, self._saved, self._generations):
+                del mapping[index]
+            self.indexes[i] = new
+            self.positions[new] = position
+            self._saved[new] = None
+            self._generations[new] = generation
+            # apply what we applied to the old generation again
+            self._applied = set([id for id in self._applied if id <= position])
+            self._floor = min(self._floor, position)
+
+    def pending(self, last_id=None):
+        """Return a queryset of the changes not yet applied to all
+        indexes, up to the id ``last_id``, if given.
+        """
+        changes = Change.objects.filter(
+            id__gt=min(self.positions.values() or [0]))
+        if last_id is not None:
+            changes = changes.filter(id__lte=last_id)
+        return changes.order_by('id')
+
+    def apply_chunk(self, last_id=None):
+        """Apply the next (up to) ``chunk_size`` pending changes, and
+        return them.
+        """
+        self.reopen_replaced()
+        pending = self.pending(last_id)
+
+        # changes that only showed up after we applied more recent ones;
+        # they can only fill the gaps above ``_floor``.
+        late = [id for id in pending.filter(id__gt=self._floor,
+                    id__lte=self._high).values_list('id', flat=True)
+                if id not in self._applied]
+        batch = late[:self.chunk_size]
+        changes = []
+        for i in range(0, len(batch), 500):
+            changes.extend(Change.objects.filter(id__in=batch[i:i+500]).\
+                select_related('content_type'))
+        if len(changes) < self.chunk_size:
+            changes.extend(pending.filter(id__gt=self._high).\
+                select_related('content_type')[:self.chunk_size-len(changes)])
+        changes.sort(key=lambda change: change.pk)
+
+        if changes:
+            for index, content_type, object_id, document in \
+                    _changed_documents(self.indexes, changes, self.positions):
+                self._write(index, content_type, object_id, document)
+            ids = [change.pk for change in changes]
+            self._applied.update(ids)
+            self._high = max([self._high] + ids)
+            self._raise_floor()
+        if len(late) > len(batch):
+            self.advance(late[len(batch)] - 1)
+        else:
+            self.advance(self._high)
+        reset_queries()
+        return changes
+
+    def apply_parallel(self, workers, last_id=None,
+                       lease_timeout=DEFAULT_LEASE_TIMEOUT):
+        """Apply all pending changes (up to the id ``last_id``), with
+        the documents being built by ``workers`` processes in parallel.
+
+        The changes are split into ranges of ``chunk_size`` changes,
+        which the workers claim one at a time (see ``parallel.run_tasks``),
+        while this process writes to the indexes. Ranges not finished
+        within ``lease_timeout`` seconds, or by a worker that died, are
+        handed to another worker.
+        """
+        self.reopen_replaced()
+        ranges = parallel.pk_ranges(self.pending(last_id), self.chunk_size)
+        numbers = dict([(index, i) for i, index in enumerate(self.indexes)])
+
+        def build((first_id, last_id)):
+            changes = Change.objects.filter(id__gte=first_id,
+                id__lte=last_id).select_related('content_type')
+            for index, content_type, object_id, document in \
+                    _changed_documents(self.indexes, changes, self.positions):
+                yield (numbers[index], content_type.pk, object_id,
+                       document and parallel._serialize(document))
 
+        # Ranges may finish in any order; we can only move our position
+        # past those that all ranges before have finished as well.
+        for number, content_type_id, object_id, data in parallel.run_tasks(
+                build, ranges, workers, lease_timeout=lease_timeout,
+                done=_in_order(ranges, self.advance)):
+            self._write(self.indexes[number],
+                        ContentType.objects.get_for_id(content_type_id),
+                        object_id, data and parallel._deserialize(data))
+
+    def _write(self, index, content_type, object_id, document):
+        if document is None:
+            index.delete(object_id, content_type=content_type)
+        else:
+            index.replace_document(document)
+
+    def advance(self, position):
+        """Note that all changes up to the id ``position`` have been
+        applied to all indexes.
+
+        The positions are not moved past changes logged less than
+        ``models.VISIBILITY_LAG`` seconds ago, since changes with lower
+        ids may still be committed; those are checked for again by
+        ``apply_chunk``, or applied again by the next update.
+        """
+        position = min(position, Change.objects.settled_id())
+        for index in self.indexes:
+            self.positions[index] = max(self.positions[index], position)
+        self._floor = max(self._floor, min(self.positions.values() or [0]))
+        self._raise_floor()
+        self.save_positions(flushed_only=True)
+
+    def _raise_floor(self):
+        while self._floor + 1 in self._applied:
+            self._floor += 1
+        self._applied = set([id for id in self._applied if id > self._floor])
+
+    def save_positions(self, flushed_only=False):
+        # Only store the position of an index once the changes up to it
+        # have been flushed; should we crash before that, they will simply
+        # be applied again.
+        # An index that a rebuild replaced since we opened it has a new
+        # position, set by the rebuild; storing ours would mean that the
+        # new generation never gets the changes in between.
+        for index in self.indexes:
+            if flushed_only and index._unflushed:
+                continue
+            if os.path.realpath(index.location) != self._generations[index]:
+                continue
+            if self.positions[index] != self._saved[index]:
+                IndexCursor.objects.set_position(cursor_name(index),
+                                                 self.positions[index])
+                self._saved[index] = self.positions[index]
+
+    def unflushed_since(self):
+        """Return the time of the earliest flush among the indexes with
+        unflushed changes, or ``None`` if all changes have been flushed.
+        """
+        times = [index._last_flush for index in self.indexes
+                 if index._unflushed]
+        return times and min(times) or None
+
+    def flush(self):
+        for index in self.indexes:
+            if index._unflushed:
+                index.flush()
+        self.save_positions()
+
+    def skipped(self):
+        """Return the number of document writes that were skipped so
+        far, since the documents did not change (see
+        ``Index.skip_unchanged``).
+        """
+        return sum([index.skipped for index in self.indexes])
+
+    def close(self):
+        try:
+            for index in self.indexes:
+                index.flush()
+            self.save_positions()
+        finally:
+            for index in self.indexes:
+                index.close()
+
+
+def apply_changes(indexes=None, flush_every=None, flush_interval=None,
+                  chunk_size=DEFAULT_CHUNK_SIZE, clear_changes=True,
+                  workers=None):
+    """Apply logged model changes to search indexes.
+
+    You may pass the indexes you want to update as a tuple, otherwise
+    all registered indexes are updated. Each index keeps track of the
+    changes that have already been applied to it (see ``IndexCursor``),
+    so indexes may be updated separately, on different schedules, and
+    even at the same time by different processes.
+
+    ``flush_every`` and ``flush_interval`` override the flush policy of
+    the indexes (see ``Index.flush_every``); use them to make changes
+    visible to searchers while a long update is still running.
+
+    Changes are read and applied ``chunk_size`` at a time. Changes
+    logged while the update is running are left for the next one, which
+    also applies the changes of the last ``models.VISIBILITY_LAG``
+    seconds again, in case changes logged before them by transactions
+    still running only become visible later.
+
+    If ``workers`` is given, the documents are built by that many
+    processes in parallel (see ``ChangeApplier.apply_parallel``).
+    Unless ``clear_changes`` is disabled, the changes that have been
+    applied to all indexes are removed from the changelog afterwards.
+    """
+    applier = ChangeApplier(indexes, flush_every, flush_interval, chunk_size)
+    last_id = Change.objects.last_id()
     try:
         log.info('Updating %d %s with %d changes...' % (
-                    len(indexes),
-                    len(indexes) == 1 and 'index' or 'indexes',
-                    Change.objects.count()))
-        for change in Change.objects.ordered():
-            _chstr = {
-                Change.Kind.add: 'added',
-                Change.Kind.update: 'updated',
-                Change.Kind.delete: 'deleted',
-            }
-
-            # apply this change to all indexes it is relevant to
-            count_affected = 0
-            for index in indexes:
-                if not index.is_reponsible(change):
-                    continue
-                else:
-                    count_affected += 1
-
-                if change.kind == Change.Kind.delete:
-                    # note it is possible that the object doesn't even
-                    # exist, if it was deleted after being created, before
-                    # we even did the first update.
-                    index.delete(change.object_id,
-                                 content_type=change.content_type)
-
-                elif change.kind in (Change.Kind.add, Change.Kind.update):
-                    try:
-                        index.update(change.content_object)
-                    except change.model.DoesNotExist:
-                        # Handle db objects gracefully. The reason this
-                        # should not happen is that a "delete" action
-                        # should normally be logged as well and is handled
-                        # separately.
-                        log.warning('\tSkipping %s #%d - the database record '
-                            'associated with this change does no longer '
-                            'exist. This should normally not happen.',
-                                change.content_type, change.object_id)
-                        continue  # iterations for other indexes will fail too
-
-                else:
-                    assert False, "unknown change kind"
-
-            log.debug('\t#%d of type "%s" was %s to %s index%s' % (
-                change.object_id, change.content_type, _chstr[change.kind],
-                count_affected, 'es' if count_affected != 1 else ''))
-
-            # this change is now handled
-            change.delete()
+                    len(applier.indexes),
+                    len(applier.indexes) == 1 and 'index' or 'indexes',
+                    applier.pending(last_id).count()))
+        if workers > 1:
+            applier.apply_parallel(workers, last_id)
+        else:
+            while applier.apply_chunk(last_id):
+                pass
+    finally:
+        applier.close()
+
+    if clear_changes:
+        collect_garbage()
+
+    if applier.skipped():
+        log.info('Skipped writing %d unchanged documents.' % \
+            applier.skipped())
+    log.info('Done.')
+
 
+def run_daemon(indexes=None, latency=2.0, chunk_size=DAEMON_CHUNK_SIZE,
+               max_wait=5.0,
+               gc_interval=300, report_interval=60):
+    """Keep applying changes as they are logged, until the process
+    receives SIGTERM or SIGINT (or ``KeyboardInterrupt`` is raised).
+
+    The indexes are kept open. Changes are applied ``chunk_size`` at a
+    time, and flushed at the latest ``latency`` seconds after they were
+    applied, or as soon as there is nothing left to do, so that searches
+    are usually only a few seconds behind the database.
+
+    If no changes are pending, the change log is polled again after an
+    increasing delay, up to ``max_wait`` seconds. Every ``gc_interval``
+    seconds, applied changes are removed from the log, as well as index
+    generations replaced by a rebuild (see ``collect_generations``), and
+    every ``report_interval`` seconds, throughput and lag are logged.
+
+    If one of the indexes is rebuilt while the daemon runs, it switches
+    to the new generation (see ``ChangeApplier.reopen_replaced``).
+    """
+    import signal
+    from django.db import transaction
+
+    stopped = []
+    def stop(signum, frame):
+        log.info('Received signal %d, shutting down...' % signum)
+        stopped.append(signum)
+    old_handlers = {}
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        old_handlers[signum] = signal.signal(signum, stop)
+
+    min_wait = 0.1
+    wait = min_wait
+    applier = ChangeApplier(indexes, flush_interval=latency,
+                            chunk_size=chunk_size)
+    last_gc = last_report = time.time()
+    applied = max_lag = last_skipped = 0
+    log.info('Applying changes to %d %s continuously...' % (
+        len(applier.indexes),
+        len(applier.indexes) == 1 and 'index' or 'indexes'))
+    try:
+        while not stopped:
+            # don't keep reading from the snapshot of a transaction
+            # opened by a previous query.
+            transaction.commit_unless_managed()
+
+            changes = applier.apply_chunk()
+            now = time.time()
+            if changes:
+                wait = min_wait
+                applied += len(changes)
+                lag = now - time.mktime(changes[0].timestamp.timetuple())
+                max_lag = max(max_lag, lag)
+                since = applier.unflushed_since()
+                if since is not None and now - since >= latency:
+                    applier.flush()
+            else:
+                # caught up, make everything visible
+                applier.flush()
+
+            if now - last_gc >= gc_interval:
+                collect_garbage()
+                collect_generations(applier.indexes)
+                last_gc = now
+            if now - last_report >= report_interval:
+                skipped = applier.skipped()
+                log.info('Applied %d changes (%.1f/s), maximum lag %.1fs, '
+                    'skipped %d unchanged documents.' % (
+                        applied, applied / (now - last_report), max_lag,
+                        skipped - last_skipped))
+                applied = max_lag = 0
+                last_skipped = skipped
+                last_report = now
+
+            if not changes and not stopped:
+                time.sleep(wait)
+                wait = min(wait * 2, max_wait)
+    except KeyboardInterrupt:
+        pass
     finally:
-        for index in indexes:
-            index.flush()
+        applier.close()
+        for signum, handler in old_handlers.items():
+            signal.signal(signum, handler)
 
     log.info('Done.')
 
 
+class _IndexReader(object):
+    """Read-only access to the documents in ``index``, through Xapian
+    directly, so that other processes can keep writing to the index.
+
+    If the index is modified while we read it, the database is reopened
+    (up to ``Index.max_search_retries`` times in a row), and iterating
+    over the ids continues after the last one seen.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        if index.shards:
+            self.databases = [
+                xapian.Database(sharding.shard_location(index.location, shard))
+                for shard in range(index.shards)]
+        else:
+            self.databases = [xapian.Database(index.location)]
+
+    def _database(self, id):
+        return self.databases[self.index.shard_for(id) or 0]
+
+    def _retrying(self, database, func, *args):
+        retries = 0
+        while True:
+            try:
+                return func(*args)
+            except xapian.DatabaseModifiedError:
+                if retries >= self.index.max_search_retries:
+                    raise
+                retries += 1
+                database.reopen()
+
+    def _iterids(self, database, after=None):
+        # the ids following ``after``, in term order
+        terms = database.allterms()
+        try:
+            item = terms.skip_to('Q' + (after or ''))
+            while item.term.startswith('Q'):
+                if item.term[1:] != after:
+                    yield item.term[1:]
+                item = terms.next()
+        except StopIteration:
+            return
+
+    def iterids(self):
+        for database in self.databases:
+            last, retries = None, 0
+            while True:
+                try:
+                    for id in self._iterids(database, last):
+                        last, retries = id, 0
+                        yield id
+                    break
+                except xapian.DatabaseModifiedError:
+                    if retries >= self.index.max_search_retries:
+                        raise
+                    retries += 1
+                    database.reopen()
+
+    def has_document(self, id):
+        database = self._database(id)
+        return self._retrying(database, database.term_exists, 'Q' + id)
+
+    def get_hash(self, id):
+        database = self._database(id)
+        return self._retrying(database, database.get_metadata, HASH_KEY % id)
+
+
+def _reconcile_documents(index, reader, chunk_size):
+    """Find the documents in ``index`` whose objects no longer exist,
+    or no longer match the queryset restriction of their model, and log
+    changes to remove them. Documents of content types not registered
+    with the index are deleted right away. Returns the number of
+    documents handled.
+
+    The documents are found by their id, so this relies on the default
+    format (see ``IndexDataBase.document_id``).
+    """
+    count = [0]
+    unregistered = set()
+
+    def check(ids):
+        # ``ids`` maps content type ids to lists of object ids
+        changes = {}
+        for content_type_id, object_ids in ids.items():
+            try:
+                model = ContentType.objects.get_for_id(content_type_id).\
+                    model_class()
+            except ContentType.DoesNotExist:
+                model = None
+            if model is None or not model in index.get_models():
+                unregistered.add(content_type_id)
+                continue
+            existing = set(model._default_manager.filter(
+                pk__in=object_ids).values_list('pk', flat=True))
+            # the queryset restriction the model was registered with
+            restriction = index._models[model]
+            if restriction is None:
+                included = existing
+            else:
+                included = set(restriction.filter(
+                    pk__in=object_ids).values_list('pk', flat=True))
+            for object_id in object_ids:
+                if not object_id in existing:
+                    changes[(content_type_id, object_id)] = Change.Kind.delete
+                elif not object_id in included:
+                    # applying an update removes the object from the
+                    # indexes whose restriction it doesn't match.
+                    changes[(content_type_id, object_id)] = Change.Kind.update
+        Change.objects.log_many(changes)
+        count[0] += len(changes)
+        reset_queries()
+
+    ids, pending = {}, 0
+    for id in reader.iterids():
+        try:
+            object_id, content_type_id = map(int, id.rsplit('-', 1))
+        except ValueError:
+            log.warning('\tIgnoring document "%s" with an unknown id '
+                'format.', id)
+            continue
+        ids.setdefault(content_type_id, []).append(object_id)
+        pending += 1
+        if pending >= chunk_size:
+            check(ids)
+            ids, pending = {}, 0
+    check(ids)
+
+    # Documents of models not registered (anymore) can't be removed
+    # through the changelog, as updates skip changes to them; their
+    # content type may not even exist. They are deleted directly.
+    if unregistered:
+        suffixes = tuple(['-%d' % id for id in unregistered])
+        stale = [id for id in reader.iterids() if id.endswith(suffixes)]
+        log.info('\tDeleting %d documents of unregistered content '
+            'types...' % len(stale))
+        for id in stale:
+            index._delete_document(id)
+        index.flush()
+        count[0] += len(stale)
+    return count[0]
+
+
+def _reconcile_model(index, reader, model, chunk_size, check_hashes=False):
+    """Find the objects of ``model`` that are missing from ``index``,
+    (or, if ``check_hashes`` is enabled, whose documents are out of
+    date), and log changes to add them. Returns the number of changes
+    logged.
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    count = 0
+
+    def document_id(object_id):
+        return index.Data(content_type=content_type,
+                          object_id=object_id).document_id()
+
+    if check_hashes:
+        changes = {}
+        for i, obj in enumerate(chunked_queryset(index.get_queryset(model),
+                                                 chunk_size)):
+            # also finds missing documents, which have no hash
+            document = index._document_for_instance(obj)
+            if reader.get_hash(document.id) != document_hash(document):
+                changes[(content_type.pk, obj.pk)] = Change.Kind.update
+            if i % chunk_size == chunk_size - 1:
+                Change.objects.log_many(changes)
+                count += len(changes)
+                changes = {}
+                reset_queries()
+        Change.objects.log_many(changes)
+        count += len(changes)
+    else:
+        for pks in chunked_pks(index.get_queryset(model), chunk_size):
+            changes = {}
+            for pk in pks:
+                if not reader.has_document(document_id(pk)):
+                    changes[(content_type.pk, pk)] = Change.Kind.add
+            Change.objects.log_many(changes)
+            count += len(changes)
+            reset_queries()
+    return count
+
+
+def reconcile(indexes=None, chunk_size=DEFAULT_CHUNK_SIZE,
+              check_hashes=False):
+    """Find differences between the indexes and the database, e.g.
+    after changes that were not logged, and log the changes needed to
+    fix them, to be applied by the next update.
+
+    All document ids of each index are compared with the database, and
+    all objects of it's models are checked for a document, ``chunk_size``
+    at a time, so memory usage does not depend on the size of the index.
+
+    If ``check_hashes`` is enabled, documents are also built for all
+    objects, and compared with the hash stored in the index, to find
+    documents that are out of date. This requires the indexes to use
+    ``skip_unchanged``.
+
+    The indexes are only read, so other processes may keep updating
+    them, with two exceptions that require opening an index for writing:
+    when ``check_hashes`` is enabled (building documents needs the
+    writer), and when documents of models no longer registered with the
+    index are found, which are deleted directly, since updates ignore
+    changes to them. In those cases, no other process may be updating
+    the index at the same time (stop the daemon); otherwise opening it
+    fails with a lock error.
+
+    Returns the number of changes logged (and documents deleted).
+    """
+    if not indexes:
+        indexes = get_indexes()
+    elif not isinstance(indexes, (list, tuple)):
+        indexes = (indexes,)
+
+    total = 0
+    for index_klass in indexes:
+        if check_hashes and not index_klass.skip_unchanged:
+            raise RuntimeError('%s does not store document hashes; enable '
+                'skip_unchanged on it, and rebuild it.' % index_klass.__name__)
+
+        log.info('Comparing %s with the database...' % index_klass.__name__)
+        index = index_klass()
+        reader = _IndexReader(index)
+        try:
+            count = _reconcile_documents(index, reader, chunk_size)
+            for model in index.get_models():
+                count += _reconcile_model(index, reader, model, chunk_size,
+                                          check_hashes)
+        finally:
+            index.close()
+        log.info('Logged %d changes.' % count)
+        total += count
+    return total
+
+
 def main(argv=None):
     """Provides a simple "update index" commandline script that you
     can easily wrap around in a custom script file:
@@ -179,13 +1401,25 @@ def main(argv=None):
     import getopt
     try:
         opts, args = getopt.getopt(argv[1:], 'hqv',
-                                   ['full-rebuild', 'update', 'help'])
+                                   ['full-rebuild', 'resume', 'model=',
+                                    'update', 'help',
+                                    'daemon', 'latency=',
+                                    'reconcile', 'check-hashes',
+                                    'index=', 'chunk-size=', 'workers=',
+                                    'flush-every=', 'flush-interval='])
     except getopt.GetoptError, e:
         return log.error(e)
     if args:
         return log.error('Commands not supported: %s' % ", ".join(args))
 
-    full_rebuild = update_only = False
+    full_rebuild = update_only = daemon = resume = False
+    reconcile_only = check_hashes = False
+    latency = 2.0
+    index_names = []
+    model_names = []
+    chunk_size = None
+    workers = None
+    flush_every = flush_interval = None
     for o, a in opts:
         if o in ('-h', '--help'):
             pass
@@ -195,15 +1429,77 @@ def main(argv=None):
             log.setLevel(logging.WARNING)
         elif o == '--full-rebuild':
             full_rebuild = True
+        elif o == '--resume':
+            resume = True
         elif o == '--update':
             update_only = True
+        elif o == '--daemon':
+            daemon = True
+        elif o == '--reconcile':
+            reconcile_only = True
+        elif o == '--check-hashes':
+            check_hashes = True
+        elif o == '--latency':
+            try:
+                latency = float(a)
+            except ValueError:
+                return log.error('Invalid number of seconds: %s' % a)
+        elif o == '--index':
+            index_names.append(a)
+        elif o == '--model':
+            model_names.append(a)
+        elif o == '--chunk-size':
+            try:
+                chunk_size = int(a)
+            except ValueError:
+                chunk_size = 0
+            if chunk_size < 1:
+                return log.error('Invalid chunk size: %s' % a)
+        elif o == '--workers':
+            try:
+                workers = int(a)
+            except ValueError:
+                return log.error('Invalid number of workers: %s' % a)
+        elif o == '--flush-every':
+            try:
+                flush_every = int(a)
+            except ValueError:
+                return log.error('Invalid number of documents: %s' % a)
+        elif o == '--flush-interval':
+            try:
+                flush_interval = float(a)
+            except ValueError:
+                return log.error('Invalid number of seconds: %s' % a)
         else:
             assert False, "unhandled option"
 
+    try:
+        indexes = find_indexes(index_names)
+        models = find_models(model_names)
+    except ValueError, e:
+        return log.error(e)
+
+    if daemon and not full_rebuild:
+        if workers:
+            return log.error('--workers is not supported with --daemon')
+        if chunk_size is None:
+            chunk_size = DAEMON_CHUNK_SIZE
+        run_daemon(indexes, latency=latency, chunk_size=chunk_size)
+        return
+    if chunk_size is None:
+        chunk_size = DEFAULT_CHUNK_SIZE
+
     if full_rebuild:
-        rebuild(clear_changes=True)
+        rebuild(indexes, clear_changes=True, chunk_size=chunk_size,
+                workers=workers, flush_every=flush_every,
+                flush_interval=flush_interval, resume=resume,
+                models=models)
+    elif reconcile_only:
+        reconcile(indexes, chunk_size=chunk_size, check_hashes=check_hashes)
     elif update_only:
-        apply_changes()
+        apply_changes(indexes, flush_every=flush_every,
+                      flush_interval=flush_interval, chunk_size=chunk_size,
+                      workers=workers)
     else:
         print """%(scriptname)s [options]
 
@@ -212,6 +1508,19 @@ Main Options:
         Handle changed records since last update. This brings the index
         up-to-date with the changes flagged in the database.
 
+    --daemon
+        Keep running, and apply changes continuously as they are logged.
+        Stop with SIGTERM.
+
+    --reconcile
+        Compare the index with the database, and log changes for all
+        differences found (e.g. due to changes that were not logged). They
+        are applied by the next update.
+
+    --check-hashes
+        With --reconcile, also find documents that are out of date.
+        Requires the index to use ``skip_unchanged``.
+
     --full-rebuild
         Completely rebuild the index from scratch. You should only need to run
         this if you make changes to the index format or the app's search code
@@ -219,7 +1528,41 @@ Main Options:
         from that, the normal incremental update mechanism should work
         flawlessly.
 
+    --resume
+        With --full-rebuild, continue an interrupted rebuild where it
+        stopped.
+
+    --model=APP_LABEL.MODEL
+        With --full-rebuild, only rebuild the documents of this model, in
+        the live index. May be given multiple times.
+
+    --index=NAME
+        Only update or rebuild the index with the given class name. May be
+        given multiple times.
+
+    --chunk-size=N
+        Number of objects (or changes, during an update) to load from
+        the database at once (default: %(chunk_size)d, or
+        %(daemon_chunk_size)d with --daemon).
+
+    --latency=SECONDS
+        With --daemon, flush applied changes after at most SECONDS
+        seconds (default: 2).
+
+    --workers=N
+        Build the documents in N processes in parallel. Not supported
+        with --daemon.
+
+    --flush-every=N
+        Flush changes to the index after every N documents.
+
+    --flush-interval=SECONDS
+        Flush changes to the index at least every SECONDS seconds.
+
 Other Options:
     -h,--help           print usage info (this)
     -q                  be extra quiet
-    -v                  be extra verbose""" % {'scriptname': os.path.basename(argv[0])}
\ No newline at end of file
+    -v                  be extra verbose""" % {
+        'scriptname': os.path.basename(argv[0]),
+        'chunk_size': DEFAULT_CHUNK_SIZE,
+        'daemon_chunk_size': DAEMON_CHUNK_SIZE}
\ No newline at end of file
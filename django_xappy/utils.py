@@ -1,5 +1,5 @@
 __all__ = (
-    'template_callable',
+    'template_callable', 'chunked_queryset', 'chunked_pks',
 )
 
 
@@ -31,4 +31,49 @@ def template_callable(func):
     class TemplateCallableDescriptor(object):
         def __get__(self, instance, klass):
             return GetAttrCaller(instance)
-    return TemplateCallableDescriptor()
\ No newline at end of file
+    return TemplateCallableDescriptor()
+
+
+def chunked_queryset(queryset, chunk_size=1000):
+    """Iterate over the objects in ``queryset`` in primary key order,
+    fetching only ``chunk_size`` rows at a time.
+
+    Simply iterating over a queryset makes Django cache the complete
+    result set, which for large tables can use up a lot of memory.
+    Instead, we repeatedly ask for the next ``chunk_size`` objects
+    following the last primary key seen, so memory usage stays flat
+    regardless of the table size. Using a ``pk > last`` condition
+    rather than an offset also means later chunks don't get slower.
+
+    Note that any ordering the queryset may have is replaced.
+    """
+    queryset = queryset.order_by('pk')
+    last_pk = None
+    while True:
+        chunk = queryset
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        for obj in chunk:
+            yield obj
+        if len(chunk) < chunk_size:
+            break
+        last_pk = chunk[-1].pk
+
+
+def chunked_pks(queryset, chunk_size=1000):
+    """Like ``chunked_queryset``, but only loads the primary keys, and
+    yields them as lists of (at most) ``chunk_size`` each.
+    """
+    pks = queryset.order_by('pk').values_list('pk', flat=True)
+    last_pk = None
+    while True:
+        chunk = pks
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        chunk = list(chunk[:chunk_size])
+        if chunk:
+            yield chunk
+        if len(chunk) < chunk_size:
+            break
+        last_pk = chunk[-1]